@@ -195,6 +195,11 @@ class reserve( trading.market, trading.agent ):
             identity		= '{} Reserve'.format( name ) # Eg. HoloFuel/USD Reserve
         super( reserve, self ).__init__( name=name, identity=identity, **kwds )
         self.reserves	= dict( reserves ) if reserves else {} # { <time>: { <price>: <amount>, ... }, ...}
+        if self.tick is not None:
+            # Key each tranche by the price of its whole number of ticks, exactly as its trades will be priced
+            self.reserves	= dict( ( timestamp, dict( ( self.ticks( price ) * self.tick, amount )
+                                                   for price,amount in tranche.items() ))
+                                for timestamp,tranche in self.reserves.items() )
         self.LIFO	= True if LIFO else False
         self.run( now=self.now )
 
@@ -228,7 +233,8 @@ class reserve( trading.market, trading.agent ):
             "A reserve is both a trading.market and an agent; no market need be supplied "
         super( reserve, self ).run( exch=self, now=now )
         self.close( self ) # close all open trades
-        # For LIFO, newest order placed first.
+        # For LIFO, newest order placed first.  All tranches' orders are entered together.
+        orders			= []
         for timestamp in sorted( self.reserves.keys(), reverse=True ):
             for price in sorted( self.reserves[timestamp].keys() ):
                 amount		= self.reserves[timestamp][price]
@@ -237,10 +243,11 @@ class reserve( trading.market, trading.agent ):
                 # we must therefore always give the "spread" on a trade to the counterparty; for limit orders
                 # it goes to the oldest (most risk) trade.  So, we must always be the "newest" trade, or we'll
                 # get the seller's ask, which may be lower than our bid...
-                self.buy( self, amount=amount, price=price, now=timestamp )
+                orders.append( trading.trade_t( self.name, price, self.currency, timestamp, amount, self ))
                 logging.info( "Issuing reserve tranche from time %16s: %5d %-20s @ %7.4f", timestamp, amount, self.name, price )
             if self.LIFO:
-                return # If LIFO, only a single (the newest) tranche is placed at a time
+                break # If LIFO, only a single (the newest) tranche is placed at a time
+        self.enter_many( orders )
 
     def record( self, order, comment=None ):
         """Adjust reserves by the amount bought/sold, retiring tranches as they are exhausted.  For reserve
@@ -262,7 +269,8 @@ class reserve( trading.market, trading.agent ):
             tranche		= self.reserves[timestamp]
             if order.price in tranche:
                 tranche[order.price] -= order.amount
-                if near( tranche[order.price], 0 ):
+                if ( self.lots( tranche[order.price] ) == 0 if self.lot is not None	# No whole lots remain
+                     else near( tranche[order.price], 0 )):
                     logging.info( "{:<20} emptied Reserve tranche @ {}${:9.4f}".format(
                         str( order.agent ), order.currency, order.price ))
                     tranche.pop( order.price )
@@ -295,9 +303,12 @@ class reserve_issuing( reserve ):
     Issue/Retire.  We can use our agent.trades list over the last hour to compute the volume and
     buy/sell ratio.
 
+    If a supply_book_period is given, the supply_book_value follows the market's recent trade prices;
+    their exponential moving average, with that time constant (see trading.aggregator).
+
     """
     def __init__( self, name, supply_available=None, supply_factor=None, supply_premium=None, supply_amount=1000000,
-                  supply_period=None, supply_ratio=None, supply_book_value=None, **kwds ):
+                  supply_period=None, supply_ratio=None, supply_book_value=None, supply_book_period=None, **kwds ):
         self.supply_book_value	= 1.0     if supply_book_value	is None else supply_book_value	# Initial supply book value
         self.supply_period	= 60 * 60 if supply_period	is None else supply_period	# 1hr
         self.supply_ratio	= 1       if supply_ratio	is None else supply_ratio	# 1/1 (neutral Issue/Retire)
@@ -306,7 +317,10 @@ class reserve_issuing( reserve ):
         assert supply_available is not None, \
             "Must provide a supply_available per {}hr period".format( self.supply_period // ( 60 * 60 ))
         self.supply_available	= supply_available
+        self.supply_aggregator	= None if supply_book_period is None else trading.aggregator( period=supply_book_period )
         super( reserve_issuing, self ).__init__( name, **kwds )
+        if self.supply_aggregator is not None:
+            self.supply_aggregator.attach( self )
     
     @property
     def supply_premium( self ):
@@ -346,6 +360,8 @@ class reserve_issuing( reserve ):
 
         """
         super( reserve_issuing, self ).run( exch=exch, now=now ) # closes all open orders, issues buys
+        if self.supply_aggregator is not None and self.supply_aggregator.ema is not None:
+            self.supply_book_value	= self.supply_aggregator.ema
         buy,sell		= self.volume( period=self.supply_period, now=now )
         supply_sold_period	= sell - buy # Could be -'ve if we've been net seller
         supply_price		= self.supply_book_value * self.supply_premium
@@ -37,6 +37,17 @@ def test_reserve_simple():
     bid,ask,last		= Holofuel_USD.price()
     assert near( bid.price, .001 )
 
+def test_reserve_fixed():
+    """A fixed-point reserve keys its tranches by whole ticks, so redemptions always find their tranche."""
+    Holofuel_USD		= reserve( name="HoloFuel/USD", reserves={0: { .1 + .2: 90 }}, tick=.0001, lot=.1 )
+    assert list( Holofuel_USD.reserves[0] ) == [ 3000 * .0001 ]
+    a1				= trading.agent( "A1" )
+    for _ in range( 3 ):
+        Holofuel_USD.sell( a1, 30, .3 )				# .3 != .1 + .2, but is the same number of ticks
+        assert len( Holofuel_USD.execute_all() ) == 1
+    assert not Holofuel_USD.reserves
+    assert near( a1.balance, 90 * .3 )
+
 def test_reserve_issuing():
     # Make
     supply_available		= 1000
@@ -146,3 +157,16 @@ def test_reserve_issuing_selective():
     assert B.assets[R.name] == -13
     
     
+
+
+def test_reserve_issuing_book_value():
+    """The supply_book_value may follow the moving average of recent trade prices."""
+    Holofuel_USD		= reserve_issuing( name="HoloFuel/USD", supply_available=1000, supply_book_value=1.00, supply_premium=1.5,
+                                                   supply_book_period=hour, now=0 )
+    a1				= trading.agent( "A1" )
+    a2				= trading.agent( "A2" )
+    Holofuel_USD.sell( a1, 10, 1.20, now=1 )
+    Holofuel_USD.buy(  a2, 10, 1.20, now=2 )
+    assert len( Holofuel_USD.execute_all( now=3 )) >= 1
+    Holofuel_USD.run( now=4 )
+    assert 1.00 < Holofuel_USD.supply_book_value <= 1.20
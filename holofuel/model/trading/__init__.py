@@ -26,6 +26,12 @@ __all__                         = ["model"]
 # Make the classes, etc. within the major components visible
 from .consts import *
 from .exchgs import *
+from .columnar import *
+from .auction import *
+from .fx import *
+from .sharded import *
+from .mirror import *
+from .indicators import *
 from .actors import *
 from .engine import *
 from .worlds import *
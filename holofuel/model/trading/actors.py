@@ -2,6 +2,7 @@
 
 """
 trading		-- Market trading simulation framework
+  .policy	-- A declarative trading compatibility policy between agent groups
   .agent        -- Minimal trading/exchange agent
   .actor	-- A basic actor in a stock market/exchange
 
@@ -30,10 +31,16 @@ __copyright__                   = "Copyright (c) 2018 Perry Kundert"
 __license__                     = "GPLv3+"
 
 import collections
+import itertools
 import logging
 import math
 import random
 
+try:
+    import numpy
+except ImportError:
+    numpy			= None	# policy.compatible_many is unavailable
+
 from .. import timer, scale, near, non_value
 
 from .exchgs import * # market, ...
@@ -49,6 +56,80 @@ need_t				= collections.namedtuple(
         ] )
 
 
+class policy( object ):
+    """A declarative trading compatibility policy between agents' compatibility groups, eg:
+
+        policy( {
+            "reserve":	dict( sells_to=( "host", ) ),	# The reserve only sells to hosts
+            "host":	dict(),				# Hosts trade with anyone (who will trade w/ them)
+        } )
+
+    Each group's rule names the groups it sells_to and buys_from (None for any group).  The rules are
+    compiled into a bit per group, and a mask per (buyer) group of every group it may buy from (that
+    will also sell to it); so checking a pair of groups is a single AND.  A group not declared
+    (eg. None) has no restrictions.
+
+    """
+    def __init__( self, rules=None ):
+        self.rules		= {}	# { <group>: ( <sells_to>, <buys_from> ), ... }; None for any group
+        self.bits		= {}	# { <group>: <bit>, ... }
+        self.masks		= {}	# { <group>: <mask of seller groups>, ... }
+        for group,rule in ( rules or {} ).items():
+            self.declare( group, **rule )
+
+    def declare( self, group, sells_to=None, buys_from=None ):
+        """Declare the group's rule, and re-compile the policy; O(G^2) in the number of groups."""
+        self.rules[group]	= ( None if sells_to  is None else frozenset( sells_to ),
+                                    None if buys_from is None else frozenset( buys_from ))
+        for g in itertools.chain( ( group, ), sells_to or (), buys_from or () ):
+            self.bits.setdefault( g, 1 << len( self.bits ))
+        self.compile()
+
+    def sells_to_group( self, seller, buyer ):
+        """The seller group's rule allows selling to the buyer group."""
+        sells_to		= self.rules.get( seller, ( None, None ))[0]
+        return sells_to is None or buyer in sells_to
+
+    def buys_from_group( self, buyer, seller ):
+        """The buyer group's rule allows buying from the seller group."""
+        buys_from		= self.rules.get( buyer, ( None, None ))[1]
+        return buys_from is None or seller in buys_from
+
+    def compile( self ):
+        """Compute each group's mask of the groups it may buy from."""
+        self.masks		= dict(
+            ( buyer, sum( bit for seller,bit in self.bits.items()
+                          if self.buys_from_group( buyer, seller ) and self.sells_to_group( seller, buyer )))
+            for buyer in self.bits )
+
+    def bit( self, group ):
+        """Return the group's bit, adding (and compiling) an undeclared group if necessary."""
+        bit			= self.bits.get( group )
+        if bit is None:
+            bit = self.bits[group] = 1 << len( self.bits )
+            self.compile()
+        return bit
+
+    def compatible( self, buyer, seller ):
+        """Whether agents of the buyer group may buy from agents of the seller group."""
+        self.bit( buyer )
+        return bool( self.masks[buyer] & self.bit( seller ))
+
+    def compatible_many( self, buyers, sellers ):
+        """Return a NumPy bool array of whether each of the buyer groups may buy from the corresponding seller
+        group; a single vectorized AND of their masks and bits.
+
+        """
+        assert numpy is not None, \
+            "The policy.compatible_many requires NumPy"
+        bits			= [ self.bit( group ) for group in sellers ]
+        for group in buyers:
+            self.bit( group )
+        dtype			= numpy.uint64 if len( self.bits ) <= 64 else object
+        masks			= numpy.array( [ self.masks[group] for group in buyers ], dtype=dtype )
+        return ( masks & numpy.array( bits, dtype=dtype )) != 0
+
+
 class agent( object ):
     """A basic trading agent.  Simply records its trades, keeps track of its net
     assets.  Has a preferred currency, which will be deduced on first trade if
@@ -87,17 +168,38 @@ class agent( object ):
     # sells_to/buys_from -- Used by market_selective to pair agreeable buyers/sellers
     # 
     #     The most basic rule that exchanges might want to follow is that agents don't want to
-    # exchange with themselves.
+    # exchange with themselves.  Beyond that, an agent may restrict the compatibility groups of the
+    # agents it will deal with (eg. only some buyers may buy from a "reserve" group agent), by
+    # overriding sells_to_group/buys_from_group.  All agents in a group must share the same rules,
+    # so that a market_grouped may decide compatibility for whole groups at once.
     # 
+    #     Or, the rules may be declared in a (shared) policy.  A market then decides whether two
+    # agents under the same policy are compatible from their groups' bitmasks alone (see
+    # market.agents_compatible), without calling sells_to/buys_from; so, agents with a policy must
+    # not override them.
+    # 
+    group			= None	# This agent's compatibility group
+    policy			= None	# A policy declaring the groups' rules, or None
+
+    def sells_to_group( self, group ):
+        """This agent will sell to agents in the group."""
+        return self.policy is None or self.policy.sells_to_group( self.group, group )
+
+    def buys_from_group( self, group ):
+        """This agent will buy from agents in the group."""
+        return self.policy is None or self.policy.buys_from_group( self.group, group )
+
     def sells_to( self, another ):
         """This agent will sell to another agent."""
-        logging.debug( "%s sells to  %s: %s", self, another, another is not self )
-        return another is not self
+        result			= another is not self and self.sells_to_group( getattr( another, 'group', None ))
+        logging.debug( "%s sells to  %s: %s", self, another, result )
+        return result
 
     def buys_from( self, another ):
         """This agent will buy from another agent"""
-        logging.debug( "%s buys from %s: %s", self, another, another is not self )
-        return another is not self
+        result			= another is not self and self.buys_from_group( getattr( another, 'group', None ))
+        logging.debug( "%s buys from %s: %s", self, another, result )
+        return result
     
     @property
     def balance( self ):
@@ -330,21 +432,26 @@ class actor( agent ):
                 # If the deadline passes, the difference will go -'ve, and the result will be > 1.
                 # If the deadline is a full cycle (or more) away, the difference will go to 1. (or
                 # more), and the result will be < 0.  Convert this into a price factor, ranging from
-                # ~10% under to ~5% over current market asking price (greatest of bid, ask and
-                # latest).
+                # ~10% under to ~5% over current market asking price (the average price of buying
+                # the shortfall from the asks, or else the greatest of bid, ask and latest).
                 proportion	= 1. - ( n.deadline - self.now ) / n.cycle
                 factor		= scale( proportion, (0., 1.), (0.90, 1.05))
-                price_tuple	= exch.price( n.security ) # bid,ask,last
-                price		= max( 0 if p is None else p.price for p in price_tuple )
+                quote		= exch.quote( security=n.security, amount=short )
+                if quote.amount >= short:
+                    price	= quote.vwap
+                else:
+                    price_tuple	= exch.price( n.security ) # bid,ask,last
+                    price	= max( 0 if p is None else p.price for p in price_tuple )
                 offer		= factor * price # If no market yet, offer could be $0 per unit.
                 logging.info(
                     "%15s needs %d %s; bidding $%7.4f (%7.4f of $%7.4f price)" % (
                         self, short, n.security, offer,
                         factor, price if price else math.nan ))
-                # Enter the trade for the required item, updating existing orders
+                # Enter the trade for the required item, updating existing orders.  The offer is
+                # only good 'til the need's deadline, when it will be re-evaluated.
                 exch.enter( trade_t( security=n.security, price=offer, currency=exch.currency,
                                      time=self.now, amount=short, agent=self ),
-                            update=True )
+                            update=True, tif=n.deadline )
         # Finally, update our needs w/ the refreshed list computed (new deadlines, etc.)
         self.needs		= needs
 
@@ -385,11 +492,14 @@ class actor( agent ):
 
         """
         excess 			= {}
-        for sec,bal in self.assets.items():
-            if exclude and sec in exclude:
-                continue
-            price_tuple		= exch.price( sec )
-            price		= max( 0 if p is None else p.price for p in price_tuple )
+        holdings		= [ sec for sec in self.assets if not ( exclude and sec in exclude ) ]
+        if hasattr( exch, 'valuations' ):
+            # A multi-currency exchange values each holding from all its markets, in our currency
+            values		= exch.valuations( holdings, currency=self.currency )
+        else:
+            values		= [ max( 0 if p is None else p.price for p in price_tuple )
+                                    for price_tuple in exch.prices( holdings ) ]
+        for sec,price in zip( holdings, values ):
             if near( price, 0 ):
                 continue
             # There is bidding on this security.  Compute the value of
@@ -414,12 +524,18 @@ class actor( agent ):
 
         for sec,val in sorted( excess.items(), key=lambda sv: -sv[1] ):
             # Sell some of the securities at current market rate (no price) we
-            # have the most excess value of, 'til we have enough.  We'll have to
-            # guess approximately how many units, because we don't know exactly
-            # what the sale price will be.  Replace any
+            # have the most excess value of, 'til we have enough.  If the bids
+            # can absorb the overage, size the sale from their average price;
+            # otherwise, we'll have to guess approximately how many units,
+            # because we don't know exactly what the sale price will be.
             overage 		= (self.assets[sec] - self.target.get( sec, 0 ))
-            amount 		= min( value // excess[sec] + 1, overage )
-            estimate 		= amount * excess[sec] / overage   # units * $/unit
+            quote		= exch.quote( security=sec, amount=-overage ) if overage > 0 else None
+            if quote and quote.amount >= overage and quote.vwap:
+                amount		= min( value // quote.vwap + 1, overage )
+                estimate	= exch.quote( security=sec, amount=-amount ).vwap * amount
+            else:
+                amount 		= min( value // excess[sec] + 1, overage )
+                estimate 	= amount * excess[sec] / overage   # units * $/unit
             print( "Sell %d of %d excess %s (worth ~%7.2f) for about %7.2f" % (
                 amount, overage, sec, val, estimate  ))
             exch.enter( trade_t( security=sec, price=math.nan, currency=exch.currency,
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+trading		-- Market simulation framework
+  .market_auction	-- A periodic batch-auction (call) market
+
+"""
+
+# This file is part of Holo Fuel
+# 
+# Holo Fuel is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Holo Fuel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Holo Fuel.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry.kundert@holo.host"
+__copyright__                   = "Copyright (c) 2018 Perry Kundert"
+__license__                     = "GPLv3+"
+
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy			= None	# The batch auction market is unavailable
+
+from .. import timer, non_value
+from .exchgs import market, trade_t
+
+
+class market_auction( market ):
+    """A call market, clearing all orders in the book at one uniform price each time it is executed.  Suits
+    an engine that collects every agent's orders and then executes the exchange once per quanta.
+
+    The clearing price is the limit price that maximizes the volume traded, from the aggregate demand
+    (all buys at or above each price, plus market-price buys) and supply (all sells at or below each
+    price, plus market-price sells) curves.  Ties are broken by the least imbalance between demand
+    and supply, then by the price nearest the last trade (or the lower median price, if none).  If
+    there are only market-price orders, the last trade price is used (if any).
+
+    Eligible orders are then filled at the clearing price in price-time priority (market-price orders
+    first), each buyer taking from the best compatible sellers, so agents' sells_to/buys_from
+    restrictions are respected.  The sellers are passed over in one pass; those incompatible with a
+    buyer remain candidates for each later buyer, but each (buyer, seller) agent pair is examined
+    only once (see compatible).  When all agents are compatible, this is one linear pass over the
+    eligible orders.
+
+    """
+    def __init__( self, name, **kwds ):
+        assert numpy is not None, \
+            "The market_auction requires NumPy"
+        super( market_auction, self ).__init__( name, **kwds )
+
+    def clearing( self ):
+        """Compute the (price, volume) that clears the current books, from their aggregate price levels; costs
+        O(L log L) in the number of levels.  The price is None if no trade is possible.
+
+        """
+        bids			= [ ( price, self.buying_depth.levels[price][0] )  for price in self.buying_depth.prices ]
+        asks			= [ ( price, self.selling_depth.levels[price][0] ) for price in self.selling_depth.prices ]
+        bought			= self.buying_depth.market[0]
+        sold			= self.selling_depth.market[0]
+        if not bids and not asks:
+            if self.last is None:
+                return None,0
+            return self.last.price,min( bought, sold )
+
+        # Both books' price levels are in ascending price order.  Demand at price p is all buys
+        # at/above p, supply all sells at/below p.
+        bprice,bamount		= numpy.array( bids, dtype=float ).reshape( -1, 2 ).T
+        sprice,samount		= numpy.array( asks, dtype=float ).reshape( -1, 2 ).T
+        bcumul			= numpy.concatenate( ( [0], numpy.cumsum( bamount )))
+        scumul			= numpy.concatenate( ( [0], numpy.cumsum( samount )))
+        prices			= numpy.unique( numpy.concatenate( ( bprice, sprice )))
+        demand			= bought + bcumul[-1] - bcumul[numpy.searchsorted( bprice, prices, 'left' )]
+        supply			= sold + scumul[numpy.searchsorted( sprice, prices, 'right' )]
+        volume			= numpy.minimum( demand, supply )
+        best			= volume.max()
+        if best <= 0:
+            return None,0
+        candidates		= numpy.flatnonzero( volume == best )
+        imbalance		= numpy.abs( demand - supply )[candidates]
+        candidates		= candidates[imbalance == imbalance.min()]
+        if self.last is not None:
+            index		= candidates[numpy.argmin( numpy.abs( prices[candidates] - self.last.price ))]
+        else:
+            index		= candidates[( len( candidates ) - 1 ) // 2]
+        return float( prices[index] ),float( best )
+
+    def execute( self, now=None, **kwds ):
+        """Clear the books at a single price, and yield all the resultant (buy, sell) trades.  The books are
+        completely adjusted before the first trade is yielded.
+
+        """
+        if now is None:
+            now			= timer()
+        self.expire( now )
+        self.depths.add( len( self.buying ) + len( self.selling ))
+        immediate		= len( self.immediate )
+        price,volume		= self.clearing()
+        logging.info( "%s auction clears %s @ %s", self, volume, price )
+        if price is None or volume <= 0:
+            self.expire_immediate( immediate )
+            return
+
+        trades			= []
+        self.rejected		= set()
+        bid,ask			= -1,0	# The best buyer, and the first seller not yet passed over
+        while bid >= -len( self.buying ) and len( self.selling ):
+            buyer		= self.buying[bid]
+            if not ( non_value( buyer.price ) or buyer.price >= price ):
+                break		# No more eligible buyers
+            # Find the best eligible seller compatible with this buyer: first among those passed over
+            # by earlier buyers (known pairs are not re-examined), then onward from ask
+            sell		= next( ( i for i in range( ask )
+                                          if self.compatible( buyer.agent, self.selling[i].agent )), None )
+            if sell is None:
+                while ( ask < len( self.selling )
+                        and ( non_value( self.selling[ask].price ) or self.selling[ask].price <= price )
+                        and not self.compatible( buyer.agent, self.selling[ask].agent )):
+                    ask	       += 1
+                if ask >= len( self.selling ) \
+                   or not ( non_value( self.selling[ask].price ) or self.selling[ask].price <= price ):
+                    bid	       -= 1	# No compatible seller; this buyer remains in the book
+                    continue
+                sell		= ask
+            seller		= self.selling[sell]
+            amount		= min( buyer.amount, -seller.amount )
+            self.transaction   += 1
+            buy = self.last	= trade_t( self.name, price, self.currency, now,  amount, buyer.agent )
+            trades.append( ( buy, trade_t( self.name, price, self.currency, now, -amount, seller.agent )))
+            # A filled order is deleted; the next order in each book moves to the same index
+            if sell < ask and amount == -seller.amount:
+                ask	       -= 1
+            self._fill( self.buying, bid, amount, now=now )
+            self._fill( self.selling, sell, amount, now=now )
+        self.expire_immediate( immediate )
+        for buy,sell in trades:
+            yield self.publish( ( self.floating( buy ),self.floating( sell )))
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+"""
+trading		-- Market simulation framework
+  .columnar_book	-- An order book stored in parallel NumPy arrays
+  .market_columnar	-- A market w/ vectorized price/crossing detection over columnar books
+
+"""
+
+# This file is part of Holo Fuel
+# 
+# Holo Fuel is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Holo Fuel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Holo Fuel.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry.kundert@holo.host"
+__copyright__                   = "Copyright (c) 2018 Perry Kundert"
+__license__                     = "GPLv3+"
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy			= None	# The columnar book and market are unavailable
+
+from .. import timer, isinf
+from .exchgs import market, trade_t, prices_t
+
+
+def _objects( orders ):
+    """A 1-D NumPy object array of the orders; numpy.array would unpack each (tuple) order into a row."""
+    array			= numpy.empty( len( orders ), dtype=object )
+    for i,order in enumerate( orders ):
+        array[i]		= order
+    return array
+
+
+class columnar_book( object ):
+    """An order book stored as parallel NumPy arrays of the two components of each order's book key (price,
+    with market-price orders as -/+inf, and time), its amount and its agent's id, beside an object array
+    of the orders themselves (so order identity is preserved).
+
+    Entered orders are held pending, and merged into the arrays in one pass (a searchsorted, and a
+    numpy.insert per column) the next time the book is read.  So, entering all of a cycle's orders
+    costs O(N + M log N), instead of O(N log N) per order.  Removing the first or last orders (the
+    usual case, when filling) is an O(1) slice of each array.
+
+    """
+    def __init__( self, key, orders=None, agents=None ):
+        assert numpy is not None, \
+            "The columnar_book requires NumPy"
+        self.key		= key
+        self.agents		= {} if agents is None else agents # { <agent>: <id>, ... }; may be shared
+        self.orders		= _objects( [] )
+        self.price		= numpy.empty( 0 )	# key[0]
+        self.time		= numpy.empty( 0 )	# key[1]
+        self.amount		= numpy.empty( 0 )
+        self.agent		= numpy.empty( 0, dtype=numpy.int64 )
+        self.pending		= []
+        self.version		= 0	# Advanced whenever orders are entered/removed (not filled)
+        for order in orders or []:
+            self.insert_order( order )
+
+    def __repr__( self ):
+        return repr( list( self ))
+
+    def __len__( self ):
+        return len( self.orders ) + len( self.pending )
+
+    def __iter__( self ):
+        return iter( self.columns()[0] )
+
+    def __reversed__( self ):
+        return iter( self.columns()[0][::-1] )
+
+    def __getitem__( self, index ):
+        return self.columns()[0][index]
+
+    def __setitem__( self, index, order ):
+        orders,_,_,amount,_	= self.columns()
+        orders[index]		= order
+        amount[index]		= order.amount
+
+    def __delitem__( self, index ):
+        """Delete the order at index, or the orders in a (contiguous) slice."""
+        self.columns()
+        if isinstance( index, slice ):
+            start,stop,_	= index.indices( len( self.orders ))
+        else:
+            start		= index + len( self.orders ) if index < 0 else index
+            stop		= start + 1
+        if start == 0:
+            keep		= slice( stop, None )
+        elif stop >= len( self.orders ):
+            keep		= slice( None, start )
+        else:
+            keep		= numpy.r_[ 0:start, stop:len( self.orders ) ]
+        self._keep( keep )
+
+    def _keep( self, keep ):
+        """Keep only the orders selected by keep (a slice, or an index or boolean array), in every column."""
+        self.orders		= self.orders[keep]
+        self.price		= self.price[keep]
+        self.time		= self.time[keep]
+        self.amount		= self.amount[keep]
+        self.agent		= self.agent[keep]
+
+    def identify( self, agent ):
+        """Return the agent's id, or None if the agent has never entered an order."""
+        return self.agents.get( agent )
+
+    def columns( self ):
+        """Merge any pending orders, and return the (orders, price, time, amount, agent) columns."""
+        if self.pending:
+            self.merge()
+        return self.orders, self.price, self.time, self.amount, self.agent
+
+    def merge( self ):
+        """Insert all pending orders into the columns, each after any existing orders with an equal key (as
+        the reference book's stable sort would), and after any earlier pending orders with an equal key.
+
+        """
+        pending			= sorted( self.pending, key=self.key )
+        self.pending		= []
+        keys			= [ self.key( order ) for order in pending ]
+        price			= numpy.array( [ k[0] for k in keys ], dtype=float )
+        time			= numpy.array( [ k[1] for k in keys ], dtype=float )
+        lo			= numpy.searchsorted( self.price, price, 'left' )
+        hi			= numpy.searchsorted( self.price, price, 'right' )
+        where			= [ l + numpy.searchsorted( self.time[l:h], t, 'right' ) if h > l else l
+                                    for l,h,t in zip( lo, hi, time ) ]
+        self.orders		= numpy.insert( self.orders, where, _objects( pending ))
+        self.price		= numpy.insert( self.price,  where, price )
+        self.time		= numpy.insert( self.time,   where, time )
+        self.amount		= numpy.insert( self.amount, where, [ order.amount for order in pending ] )
+        self.agent		= numpy.insert( self.agent,  where, [ self.agents.setdefault( order.agent, len( self.agents ))
+                                                                      for order in pending ] )
+
+    def insert_order( self, order ):
+        self.pending.append( order )
+        self.version	       += 1
+
+    def insert_orders( self, orders ):
+        self.pending.extend( orders )
+        self.version	       += 1
+
+    def remove_order( self, order ):
+        """Remove the specified order (by identity); searches only the run of orders with its key."""
+        self.version	       += 1
+        for index,existing in enumerate( self.pending ):
+            if existing is order:
+                del self.pending[index]
+                return
+        orders,price,time,_,_	= self.columns()
+        p,t			= self.key( order )
+        lo			= numpy.searchsorted( price, p, 'left' )
+        hi			= numpy.searchsorted( price, p, 'right' )
+        for index in range( lo + numpy.searchsorted( time[lo:hi], t, 'left' ), hi ):
+            if orders[index] is order:
+                del self[index]
+                return
+        raise ValueError( "Order not in book: {}".format( order ))
+
+    def remove_orders( self, predicate ):
+        """Remove all orders satisfying the predicate."""
+        self.version	       += 1
+        orders,_,_,_,_		= self.columns()
+        self._keep( numpy.array( [ not predicate( order ) for order in orders ], dtype=bool ))
+
+    def copy( self ):
+        """A copy of the book, sharing its orders (and agent ids).  Only the orders and amount columns are
+        altered in place (see __setitem__); the others are always replaced, so may be shared.
+
+        """
+        copy			= object.__new__( self.__class__ )
+        copy.__dict__.update( self.__dict__ )
+        copy.orders		= self.orders.copy()
+        copy.amount		= self.amount.copy()
+        copy.pending		= self.pending[:]
+        return copy
+
+
+class market_columnar( market ):
+    """A market over columnar_book buying/selling books, yielding the same trades as the reference market.
+
+    The best bid/ask (ignoring market-price orders) are found by a searchsorted on each book's price
+    column, and trade_possible is a single comparison of price keys.
+
+    When executing a run of crossing limit-price orders, the whole run is executed at once (see
+    execute_run): the extent of the opposing books that can possibly trade is found by searchsorted,
+    and each trade's buyer, seller and amount from the union of the cumulative sums of their amounts
+    (the volumes at which each order is exhausted).  Each trade's agents are still confirmed with
+    compatible, in order (stopping at the first pair that are not, as the reference market does).
+    Then each book's remaining amounts are stored in a single slice assignment, and its exhausted
+    orders deleted in a single slice (see _fill_run).  Market-price orders are traded one at a time,
+    exactly as by the reference market.
+
+    So, a run is settled before its first trade is yielded; the caller must consume every trade (as
+    execute does), and orders entered or cancelled while they are yielded take part only in the
+    next run.  If rescan is True (execute re-scans after each trade), or any amount in the run is not
+    whole (a cumulative sum of fractional amounts may differ in its last bit from the reference
+    market's repeated subtractions), each run is limited to a single trade.
+
+    On 10^5 random orders, execute takes ~1.4s: ~25% less than filling one trade at a time did (~1.8s),
+    and on par with market_sorted (~1.3-1.5s); ~35% less (1.4s vs. 2.1s), if all are limit-price
+    orders.  The order-of-magnitude speedup sought by vectorizing is not achieved, since each trade
+    is still a trade_t yielded (and published) by execute, and each exhausted order still removed
+    from the agent indices, by Python code.  Entering orders one at a time is faster (~2-3x), since
+    they are merged into the columns once, when the book is next read; enter_many is within ~30% of
+    market_sorted (faster or slower, depending on NumPy), which already merges a batch in one sort.
+
+    """
+    book_class			= columnar_book
+
+    def __init__( self, name, **kwds ):
+        super( market_columnar, self ).__init__( name, **kwds )
+        self.selling.agents	= self.buying.agents	# Share agent ids between the books
+
+    def _price( self ):
+        orders,price,_,_,_	= self.buying.columns()
+        index			= numpy.searchsorted( price, math.inf, 'left' ) - 1
+        bid			= orders[index] if index >= 0 else None
+        orders,price,_,_,_	= self.selling.columns()
+        index			= numpy.searchsorted( price, -math.inf, 'right' )
+        ask			= orders[index] if index < len( orders ) else None
+        return prices_t( self.floating( bid ), self.floating( ask ), self.floating( self.last ))
+
+    def trade_possible( self, bid=-1, ask=0 ):
+        return ( bid < 0 and ask >= 0
+                 and bid >= -len( self.buying )
+                 and ask <   len( self.selling )
+                 and self.selling.columns()[1][ask] <= self.buying.columns()[1][bid] )
+
+    def execute_possible( self, now=None, bid=-1, ask=0 ):
+        if now is None:
+            now			= timer()
+        while self.trade_possible( bid=bid, ask=ask ):
+            if isinf( self.buying.columns()[1][bid] ) or isinf( self.selling.columns()[1][ask] ):
+                # A market-price order; its price may require a search of the books.  Trade one.
+                traded		= False
+                for trade in super( market_columnar, self ).execute_possible( now=now, bid=bid, ask=ask ):
+                    traded	= True
+                    yield trade
+                    break
+                if not traded:
+                    break
+                continue
+            trades,stopped	= self.execute_run( now, bid=bid, ask=ask )
+            for trade in trades:
+                yield trade
+            if stopped:
+                break
+
+    def execute_run( self, now, bid=-1, ask=0 ):
+        """Execute the run of crossing limit-price orders from buying[bid] downward and selling[ask] upward,
+        returning its (buy, sell) trades, and whether it stopped at a pair of incompatible agents.
+
+        """
+        borders,bprice,_,bamount,_ = self.buying.columns()
+        sorders,sprice,_,samount,_ = self.selling.columns()
+        # Buyers from bid downward that cross the best ask, and sellers from ask upward that cross the
+        # best bid.  Each trade ends at the next volume at which a buyer or seller is exhausted; its
+        # buyer and seller are those not yet exhausted at the volume where it starts.
+        top			= len( bprice ) + bid
+        low			= numpy.searchsorted( bprice[:top+1], sprice[ask], 'left' )
+        high			= numpy.searchsorted( sprice, bprice[bid], 'right' )
+        bcumul			= numpy.cumsum( bamount[low:top+1][::-1] )
+        scumul			= -numpy.cumsum( samount[ask:high] )
+        whole			= self.rescan is not True and not ( bcumul % 1 ).any() and not ( scumul % 1 ).any()
+        if whole:
+            bcumul,scumul	= bcumul.astype( numpy.int64 ),scumul.astype( numpy.int64 )
+        volume			= min( bcumul[-1], scumul[-1] )
+        ends			= numpy.union1d( bcumul[bcumul <= volume], scumul[scumul <= volume] )
+        starts			= numpy.concatenate( ( [ 0 ], ends[:-1] ))
+        buyers			= numpy.searchsorted( bcumul, starts, 'right' )
+        sellers			= numpy.searchsorted( scumul, starts, 'right' )
+        # Prices cross less with each trade down the books; count those that still cross
+        count			= int( numpy.count_nonzero( sprice[ask + sellers] <= bprice[top - buyers] ))
+        if not whole:
+            count		= min( count, 1 )
+        trades			= []
+        stopped			= False
+        for buyer,seller,amount in zip( borders[top - buyers[:count]], sorders[ask + sellers[:count]],
+                                        ( ends[:count] - starts[:count] ).tolist() ):
+            if not self.compatible( buyer.agent, seller.agent ):
+                stopped		= True
+                break
+            # The earlier order (who took the greater risk) gets the "spread"
+            price		= seller.price if buyer.time < seller.time else buyer.price
+            trades.append( ( trade_t( self.name, price, self.currency, now,  amount, buyer.agent ),
+                             trade_t( self.name, price, self.currency, now, -amount, seller.agent )))
+        if trades:
+            count		= len( trades )
+            self.transaction   += count
+            self.last		= trades[-1][0]
+            self._fill_run( self.buying, top, bcumul[:buyers[count-1]+1], ends[count-1], buyers[:count], now )
+            self._fill_run( self.selling, ask, scumul[:sellers[count-1]+1], ends[count-1], sellers[:count], now )
+        return trades,stopped
+
+    def _fill_run( self, book, start, cumul, volume, fills, now ):
+        """Fill volume from the run of orders from book[start] (downward, in the buying book), whose amounts'
+        cumulative sums are cumul; each run order i takes part in the trades where fills == i.  The
+        remaining amounts are stored in one slice assignment, and the exhausted orders (always the
+        first in the run) deleted in one slice.  Otherwise, each order is filled as by _fill.
+
+        """
+        buying			= book is self.buying
+        book			= self._thaw( book )
+        orders,_,_,amount,_	= book.columns()
+        filled			= numpy.minimum( cumul, volume ) - numpy.concatenate( ( [ 0 ], cumul[:-1] ))
+        counts			= numpy.bincount( fills, minlength=len( cumul ))
+        if buying:
+            run			= slice( start - len( cumul ) + 1, start + 1 )
+            filled,counts	= filled[::-1],counts[::-1]
+            amount[run]		= amount[run] - filled
+        else:
+            run			= slice( start, start + len( cumul ))
+            amount[run]		= amount[run] + filled
+        depth			= self.buying_depth if buying else self.selling_depth
+        exhausted		= []
+        for index,order,fill,times in zip( range( run.start, run.stop ), orders[run],
+                                           filled.tolist(), counts.tolist() ):
+            self.ages.add( now - order.time, times )
+            if not order.filled:
+                self.waits.add( now - order.time )
+            remains		= order.amount - fill if buying else order.amount + fill
+            depth.change( order.price, -fill, 0 if remains else -1 )
+            if remains:
+                if order.generation < self.generation:
+                    order	= self._unshare( order )
+                order.amount	= remains
+                order.filled   += fill
+                orders[index]	= order
+                if self.journal is not None:
+                    self.journal.append( ( order.id, order.trade() ))
+            else:
+                exhausted.append( order )
+        if exhausted:
+            if buying:
+                del book[run.stop - len( exhausted ):run.stop]
+            else:
+                del book[run.start:run.start + len( exhausted )]
+            for order in exhausted:
+                self._filled( order )
@@ -73,9 +73,10 @@ class engine_status( engine ):
         return False # Suppress no exceptions
 
     def status( self, now ):
-        logging.info( "%s Orders:\n%s",
-                      "Exit" if now is None else self.world.format_now( now ),
-                      self.exchange.format_book() )
+        if logging.getLogger().isEnabledFor( logging.INFO ):
+            logging.info( "%s Orders:\n%s",
+                          "Exit" if now is None else self.world.format_now( now ),
+                          self.exchange.format_book() )
 
     def cycle( self, now, **kwds ):
         super( engine_status, self ).cycle( now=now, **kwds )
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+trading		-- Market simulation framework
+  .exchange_fx		-- An exchange of markets in several currencies, w/ a cached conversion rate matrix
+
+"""
+
+# This file is part of Holo Fuel
+# 
+# Holo Fuel is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Holo Fuel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Holo Fuel.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry.kundert@holo.host"
+__copyright__                   = "Copyright (c) 2018 Perry Kundert"
+__license__                     = "GPLv3+"
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy			= None	# The multi-currency exchange is unavailable
+
+from .exchgs import exchange
+
+
+class exchange_fx( exchange ):
+    """An exchange hosting markets in any of several currencies; the first (or the exchange's own, deduced
+    from its "Exchange/Currency" name) is the currency in which it values holdings.  A security's
+    market in the exchange's currency is named by the security alone, as usual; its markets in
+    other currencies by "Security/Currency" (eg. price( "HOT/EUR" )).
+
+    A market for one of the currencies, in another (eg. "EUR/USD"), is an FX market.  The rates()
+    matrix of conversions between every pair of currencies is derived from the FX markets' prices
+    (the last trade, or else the mid of the bid and ask), and crossed through intermediate
+    currencies where no direct market exists.  It is cached, and an FX market's rate is re-derived
+    only if its books have changed (see market.version); so, when no FX market has traded, a
+    conversion costs O(P) in the number of FX markets, plus a matrix lookup.
+
+    """
+    def __init__( self, name, currency=None, currencies=None, **kwds ):
+        assert numpy is not None, \
+            "The exchange_fx requires NumPy"
+        super( exchange_fx, self ).__init__( name, currency=currency, **kwds )
+        self.currencies		= [ self.currency ] + [ c for c in currencies or () if c != self.currency ]
+        self.currency_index	= dict( ( c, i ) for i,c in enumerate( self.currencies ))
+        self.listings		= {}	# { <security>: [ <market>, ... ] }; each security's markets, in any currency
+        self.pairs		= {}	# { <market>: [ <version>, <rate> ] }; each FX market's rate, as of that version
+        self.direct		= numpy.full( ( len( self.currencies ), ) * 2, math.nan )
+        numpy.fill_diagonal( self.direct, 1. )
+        self.crossed		= None	# The rates matrix, 'til a direct rate changes
+
+    def _market( self, security, currency=None ):
+        """Return the market for the security (eg. "HOT", or "HOT/EUR") in the currency, creating one if necessary."""
+        if '/' in security:
+            security,currency	= security.split( '/', 1 )
+        currency		= currency or self.currency
+        key			= security if currency == self.currency else '/'.join(( security, currency ))
+        if key not in self.markets:
+            assert currency in self.currency_index, \
+                "Unable to enter orders for {} in {}$; only {} trades supported".format(
+                    security, currency, ", ".join( c + '$' for c in self.currencies ))
+            mkt			= self.market_class( '/'.join(( security, currency )), currency=currency )
+            mkt.relays		= self.subscribers
+            self.markets[key]	= mkt
+            self.listings.setdefault( security, [] ).append( mkt )
+            if security in self.currency_index and security != currency:
+                self.pairs[mkt]	= [ None, None ]
+        return self.markets[key]
+
+    def buy( self, agent, amount, price=None, security=None, now=None, update=True, tif=None ):
+        assert security, "Must specify security to buy on exchange"
+        mkt			= self._market( security )
+        return mkt.buy( agent, amount, price=price, security=mkt.name, now=now, update=update, tif=tif )
+
+    def sell( self, agent, amount, price=None, security=None, now=None, update=True, tif=None ):
+        assert security, "Must specify security to sell on exchange"
+        mkt			= self._market( security )
+        return mkt.sell( agent, amount, price=price, security=mkt.name, now=now, update=update, tif=tif )
+
+    @staticmethod
+    def _rate( mkt ):
+        """The FX market's price of its security (a currency) in its currency; the last trade, or else the mid
+        of the bid and ask (or either), or None if it has no price.
+
+        """
+        bid,ask,last		= mkt.price()
+        if last is not None:
+            return last.price
+        prices			= [ o.price for o in ( bid, ask ) if o is not None ]
+        return sum( prices ) / len( prices ) if prices else None
+
+    def rates( self ):
+        """Return the matrix of conversion rates; the value of 1 unit of self.currencies[i] is rates()[i,j] units
+        of self.currencies[j] (NaN, if there is no way to convert them).  The returned matrix must
+        not be altered.
+
+        """
+        changed			= False
+        for mkt,pair in self.pairs.items():
+            if pair[0] == mkt.version:
+                continue
+            pair[0]		= mkt.version
+            rate		= self._rate( mkt )
+            if rate == pair[1]:
+                continue
+            pair[1]		= rate
+            changed		= True
+            i,j			= self.currency_index[mkt.name],self.currency_index[mkt.currency]
+            if rate:
+                self.direct[i,j],self.direct[j,i] = rate,1. / rate
+            else:
+                self.direct[i,j] = self.direct[j,i] = math.nan
+        if changed or self.crossed is None:
+            # Fill each unknown rate by crossing through each currency in turn (Floyd-Warshall); O(C^3)
+            crossed		= self.direct.copy()
+            for k in range( len( self.currencies )):
+                crossed		= numpy.where( numpy.isnan( crossed ), numpy.outer( crossed[:,k], crossed[k,:] ), crossed )
+            self.crossed	= crossed
+        return self.crossed
+
+    def rate( self, source, target=None ):
+        """The value of 1 unit of the source currency in the target currency (default: the exchange's); NaN if
+        there is no conversion (eg. either is not one of the exchange's currencies).
+
+        """
+        i,j			= self.currency_index.get( source ),self.currency_index.get( target or self.currency )
+        if i is None or j is None:
+            return 1. if source == ( target or self.currency ) else math.nan
+        return float( self.rates()[i,j] )
+
+    def convert( self, amount, source, target=None ):
+        """The value of amount of the source currency, in the target currency (default: the exchange's)."""
+        return amount * self.rate( source, target )
+
+    def valuations( self, securities, currency=None ):
+        """Return the value of 1 unit of each security in the currency (default: the exchange's); the greatest
+        of the bid, ask and last prices in any of its markets, converted.  A security with no price
+        (or no conversion) in any market is valued at 0; so, every security is, in a currency that is
+        not one of the exchange's.
+
+        """
+        rates			= self.rates()
+        target			= self.currency_index.get( currency or self.currency )
+        if target is None:
+            return [ 0 ] * len( securities )
+        values			= []
+        for security in securities:
+            value		= 0
+            for mkt in self.listings.get( security, () ):
+                price		= max( 0 if p is None else p.price for p in mkt.price() )
+                rate		= rates[self.currency_index[mkt.currency],target]
+                if price and not math.isnan( rate ):
+                    value	= max( value, price * rate )
+            values.append( value )
+        return values
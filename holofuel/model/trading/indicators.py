@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+trading		-- Market simulation framework
+  .bars		-- Ring buffer of OHLCV bars at one time resolution
+  .aggregator	-- Incremental OHLCV bars and price indicators of a market's trades
+  .histogram	-- A streaming histogram in logarithmic buckets
+
+"""
+
+# This file is part of Holo Fuel
+# 
+# Holo Fuel is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Holo Fuel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Holo Fuel.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry.kundert@holo.host"
+__copyright__                   = "Copyright (c) 2018 Perry Kundert"
+__license__                     = "GPLv3+"
+
+import bisect
+import collections
+import math
+
+from .consts import minute, hour, day
+
+
+bar_t				= collections.namedtuple(
+    'Bar', [
+        'time',		# Start of the bar's period
+        'open',
+        'high',
+        'low',
+        'close',
+        'volume',	# Total amount traded
+        'value',	# Total of amount * price traded (value / volume is the bar's VWAP)
+        ] )
+
+
+class bars( object ):
+    """The OHLCV bars of the trades in each period of the given resolution, in a ring buffer of the latest
+    length bars (periods without trades have no bar).  Adding a trade costs O(1).  The total volume
+    and value of the buffered bars are kept as bars are added and fall out of the buffer, so their
+    VWAP is also O(1).
+
+    """
+    def __init__( self, resolution, length=100 ):
+        self.resolution		= resolution
+        self.ring		= collections.deque( maxlen=length ) # [ [ <time>, <open>, ..., <value> ], ... ]
+        self.volume		= 0	# Total volume and value of the bars in the ring
+        self.value		= 0
+
+    def __len__( self ):
+        return len( self.ring )
+
+    def __iter__( self ):
+        """Yield each bar_t, oldest first."""
+        for bar in self.ring:
+            yield bar_t( *bar )
+
+    def __getitem__( self, index ):
+        return bar_t( *self.ring[index] )
+
+    def add( self, time, price, amount ):
+        """Add a trade of amount (+'ve) at price to the bar of its period, beginning a new bar if necessary."""
+        start			= time - time % self.resolution
+        if not self.ring or self.ring[-1][0] < start:
+            if len( self.ring ) == self.ring.maxlen:
+                oldest		= self.ring[0]	# About to fall out of the ring
+                self.volume    -= oldest[5]
+                self.value     -= oldest[6]
+            self.ring.append( [ start, price, price, price, price, 0, 0 ] )
+        bar			= self.ring[-1]
+        bar[2]			= max( bar[2], price )
+        bar[3]			= min( bar[3], price )
+        bar[4]			= price
+        bar[5]		       += amount
+        bar[6]		       += amount * price
+        self.volume	       += amount
+        self.value	       += amount * price
+
+    def vwap( self ):
+        """The volume-weighted average price of the buffered bars, or None."""
+        return self.value / self.volume if self.volume else None
+
+
+class aggregator( object ):
+    """Maintains OHLCV bars at several resolutions (by default, minute, hour and day), and price indicators,
+    from each trade a market (or exchange) executes; see attach.  Each trade costs O(1) per
+    resolution.
+
+    The ema is an exponential moving average of the trade prices (weighted by their amounts), decaying
+    with the time constant period; so, many trades at the same time (eg. from one execute) are
+    averaged fairly.  The vwap of the trades in each resolution's bars is also available.
+
+    """
+    def __init__( self, resolutions=None, length=100, period=hour ):
+        self.bars		= collections.OrderedDict(
+            ( resolution, bars( resolution, length=length ))
+            for resolution in ( resolutions or ( minute, hour, day )))
+        self.period		= period
+        self.last		= None	# The last trade (buy)
+        self.weight		= 0	# Decayed total amount, and amount * price, for the ema
+        self.value		= 0
+
+    def attach( self, market ):
+        """Subscribe to the trades of the market (or exchange), returning the subscription."""
+        return market.subscribe( callback=self.update )
+
+    def update( self, trade ):
+        """Add a (buy, sell) trade.  Trades are expected in ascending time order."""
+        buy,_			= trade
+        if self.last is not None and buy.time > self.last.time:
+            decay		= math.exp( -( buy.time - self.last.time ) / self.period )
+            self.weight	       *= decay
+            self.value	       *= decay
+        self.weight	       += buy.amount
+        self.value	       += buy.amount * buy.price
+        self.last		= buy
+        for resolution in self.bars.values():
+            resolution.add( buy.time, buy.price, buy.amount )
+
+    @property
+    def ema( self ):
+        """The exponential moving average of the trade prices, or None if no trades."""
+        return self.value / self.weight if self.weight else None
+
+    def vwap( self, resolution=None ):
+        """The volume-weighted average price of the trades in the resolution's (default: the longest) bars."""
+        return self.bars[resolution or max( self.bars )].vwap()
+
+
+class histogram( object ):
+    """A streaming histogram of values (eg. times), counted in logarithmic buckets; each bucket is base times
+    wider than the last, beginning at minimum (all values below minimum share bucket 0).  So, the
+    memory required is O(log( max / minimum )), however many values are added, and each add costs
+    O(log B) in the number of buckets (a bisect of their bounds, so exact powers of base fall in the
+    bucket they begin).  The count, total, minimum and maximum values are exact; quantiles are
+    approximate (to within a bucket).
+
+    """
+    def __init__( self, base=2, minimum=1 ):
+        self.base		= base
+        self.minimum		= minimum
+        self.buckets		= {}	# { <index>: <count>, ... }
+        self.uppers		= [ minimum ]	# [ <upper>, ... ]; each bucket's upper bound, 'til one exceeds every value
+        self.count		= 0
+        self.total		= 0
+        self.lowest		= None
+        self.highest		= None
+
+    def __len__( self ):
+        return self.count
+
+    def __iter__( self ):
+        """Yield the ( <lower>, <upper>, <count> ) of each non-empty bucket, in ascending order."""
+        for index in sorted( self.buckets ):
+            yield self.bounds( index ) + ( self.buckets[index], )
+
+    def bounds( self, index ):
+        """The ( <lower>, <upper> ) values of the bucket; bucket 0 has no lower bound."""
+        if index == 0:
+            return -math.inf,self.minimum
+        return self.uppers[index - 1],self.uppers[index]
+
+    def add( self, value, count=1 ):
+        assert not math.isinf( value ), \
+            "Unable to add {!r} to a histogram".format( value )
+        while self.uppers[-1] <= value:
+            self.uppers.append( self.minimum * self.base ** len( self.uppers ))
+        index			= bisect.bisect_right( self.uppers, value )
+        self.buckets[index]	= self.buckets.get( index, 0 ) + count
+        self.count	       += count
+        self.total	       += value * count
+        self.lowest		= value if self.lowest is None else min( self.lowest, value )
+        self.highest		= value if self.highest is None else max( self.highest, value )
+
+    def mean( self ):
+        return self.total / self.count if self.count else None
+
+    def quantile( self, q ):
+        """The approximate value below which the fraction q of the values lie (the upper bound of its bucket, but
+        no greater than the maximum value), or None if there are no values.
+
+        """
+        if not self.count:
+            return None
+        seen			= 0
+        for index in sorted( self.buckets ):
+            seen	       += self.buckets[index]
+            if seen >= q * self.count:
+                return min( self.bounds( index )[1], self.highest )
+        return self.highest
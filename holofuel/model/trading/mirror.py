@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+trading		-- Market simulation framework
+  .book_mirror		-- A market's top-of-book and L2 depth, mirrored in shared memory for other processes
+
+"""
+
+# This file is part of Holo Fuel
+# 
+# Holo Fuel is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Holo Fuel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Holo Fuel.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry.kundert@holo.host"
+__copyright__                   = "Copyright (c) 2018 Perry Kundert"
+__license__                     = "GPLv3+"
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy			= None	# The book mirror is unavailable
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory		= None	# Python < 3.8; the book mirror is unavailable
+
+
+class book_mirror( object ):
+    """A market's top-of-book and best levels of L2 depth, published into a named shared memory segment, so
+    that readers in other processes may take NumPy views of them without any IPC round-trip.
+
+    The segment holds an int64 header [ <sequence>, <levels>, <bids>, <asks> ], then the float64 top
+    [ <bid>, <bid amount>, <ask>, <ask amount>, <last>, <last amount> ], and the bid and ask
+    depth; each up to levels rows of [ <price>, <amount> ], best first (market-price orders are
+    ignored).  Absent values are NaN, and all amounts are +'ve.
+
+    The sequence is a seqlock: the writer makes it odd while publishing, and even again when done.
+    A reader wanting a consistent copy uses read, which retries until it copies the values between
+    two reads of the same even sequence.  Or, a reader may use the (zero-copy) top/bids/asks views
+    directly, between a begin and a successful valid (or else retry).
+
+    Create one via market.mirror (which publishes after each execute_all), and attach to it from
+    other processes by its name.  Publishing re-writes the segment only if the market's books have
+    changed (see market.version).
+
+    """
+    HEADER			= 4
+    TOP				= 6
+
+    def __init__( self, name=None, levels=10, create=True ):
+        assert numpy is not None and shared_memory is not None, \
+            "The book_mirror requires NumPy and multiprocessing.shared_memory"
+        if create:
+            self.memory		= shared_memory.SharedMemory(
+                name=name, create=True, size=8 * ( self.HEADER + self.TOP + 4 * levels ))
+        else:
+            self.memory		= shared_memory.SharedMemory( name=name )
+            levels		= int( numpy.ndarray( ( self.HEADER, ), dtype=numpy.int64, buffer=self.memory.buf )[1] )
+        self.name		= self.memory.name
+        self.levels		= levels
+        self.version		= None	# The market version last published
+        self.header		= numpy.ndarray( ( self.HEADER, ), dtype=numpy.int64, buffer=self.memory.buf )
+        self.top		= numpy.ndarray( ( self.TOP, ), dtype=numpy.float64, buffer=self.memory.buf,
+                                         offset=8 * self.HEADER )
+        self.bids		= numpy.ndarray( ( levels, 2 ), dtype=numpy.float64, buffer=self.memory.buf,
+                                         offset=8 * ( self.HEADER + self.TOP ))
+        self.asks		= numpy.ndarray( ( levels, 2 ), dtype=numpy.float64, buffer=self.memory.buf,
+                                         offset=8 * ( self.HEADER + self.TOP + 2 * levels ))
+        if create:
+            self.header[:]	= 0, levels, 0, 0
+            self.top[:]		= math.nan
+            self.bids[:]	= math.nan
+            self.asks[:]	= math.nan
+
+    @classmethod
+    def attach( cls, name ):
+        """Attach to an existing book_mirror by its name (eg. in another process), to read it."""
+        return cls( name=name, create=False )
+
+    def close( self ):
+        """Release this process' views and mapping of the segment."""
+        self.header = self.top = self.bids = self.asks = None
+        self.memory.close()
+
+    def unlink( self ):
+        """Destroy the segment (by its creator, when all processes are done with it)."""
+        self.memory.unlink()
+
+    def publish( self, market ):
+        """Write the market's top-of-book and L2 depth, if its books have changed since last published."""
+        if market.version == self.version:
+            return False
+        self.version		= market.version
+        top			= [ math.nan ] * self.TOP
+        for i,order in enumerate( market.price() ):
+            if order is not None:
+                top[2*i:2*i+2]	= order.price,abs( order.amount )
+        tick,lot		= market.tick or 1,market.lot or 1
+        bids			= [ ( price * tick, market.buying_depth.levels[price][0] * lot )
+                                    for price in market.buying_depth.prices[::-1][:self.levels] ]
+        asks			= [ ( price * tick, market.selling_depth.levels[price][0] * lot )
+                                    for price in market.selling_depth.prices[:self.levels] ]
+        self.header[0]	       += 1	# Odd; readers retry
+        self.top[:]		= top
+        self.bids[:len( bids )]	= bids
+        self.bids[len( bids ):]	= math.nan
+        self.asks[:len( asks )]	= asks
+        self.asks[len( asks ):]	= math.nan
+        self.header[2:]		= len( bids ),len( asks )
+        self.header[0]	       += 1	# Even; consistent
+        return True
+
+    def begin( self ):
+        """Wait for the mirror to be consistent, returning its sequence, for valid."""
+        while True:
+            sequence		= int( self.header[0] )
+            if not sequence & 1:
+                return sequence
+
+    def valid( self, sequence ):
+        """Whether the mirror has remained unchanged since begin returned the sequence."""
+        return int( self.header[0] ) == sequence
+
+    def read( self ):
+        """Return a consistent copy of the ( <sequence>, <top>, <bids>, <asks> ), w/ only the levels present."""
+        while True:
+            sequence		= self.begin()
+            bids,asks		= self.header[2:]
+            top,bids,asks	= self.top.copy(),self.bids[:bids].copy(),self.asks[:asks].copy()
+            if self.valid( sequence ):
+                return sequence,top,bids,asks
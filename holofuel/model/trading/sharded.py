@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+
+"""
+trading		-- Market simulation framework
+  .agent_proxy		-- Stands in for an agent, within a shard process
+  .market_view		-- A shard's market prices and L2 depth, for quotes
+  .exchange_sharded	-- An exchange w/ its markets partitioned across shard processes
+  .execute_pooled	-- Execute an exchange's markets concurrently, in a pool's worker processes
+
+"""
+
+# This file is part of Holo Fuel
+# 
+# Holo Fuel is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Holo Fuel is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Holo Fuel.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, division
+
+__author__                      = "Perry Kundert"
+__email__                       = "perry.kundert@holo.host"
+__copyright__                   = "Copyright (c) 2018 Perry Kundert"
+__license__                     = "GPLv3+"
+
+import collections
+import io
+import itertools
+import multiprocessing
+import pickle
+import types
+
+from .. import timer
+from . import actors, exchgs
+from .exchgs import exchange, market, order_journal, prices_t, quote_t, quote_depth, subscription, trade_t, UNCHANGED
+
+
+# The calls that leave a shard's books unchanged; any other call discards the shard's cached query results
+_queries			= set(( 'register', 'view', 'price', 'order_items', 'format_book' ))
+
+# An agent's compatibility is decided in a shard by its agent_proxy, so these must not be overridden
+_compatibility			= ( 'sells_to', 'buys_from', 'sells_to_group', 'buys_from_group' )
+
+# A market's attributes that remain w/ it in this process, while it is executed in a pool's worker
+_retained			= ( 'subscribers', 'relays', 'mirrored', 'snapped', 'snapshots', 'journal', 'shared' )
+
+
+def _compatible( agent ):
+    """Assert that the agent's compatibility may be decided by its agent_proxy."""
+    for name in _compatibility:
+        assert getattr( type( agent ), name, None ) in ( None, getattr( actors.agent, name )), \
+            "Agent {} overrides {}; its compatibility cannot be decided in a shard".format( agent, name )
+
+
+class agent_proxy( object ):
+    """An agent's stand-in within a shard; it carries only the agent's token, and its compatibility group and
+    policy.  So, agents' compatibility within a shard is decided just as for a basic agent (see
+    agent.sells_to/buys_from); agents that override sells_to/buys_from (or sells_to_group/
+    buys_from_group) are refused by exchange_sharded.
+
+    Each shard is sent an agent's group and policy once, when the agent is first seen; thereafter, a
+    proxy is pickled as its token alone, and the shard substitutes its registered proxy.
+
+    """
+    def __init__( self, token, group=None, policy=None ):
+        self.token		= token
+        self.group		= group
+        self.policy		= policy
+
+    def __reduce__( self ):
+        return agent_proxy, ( self.token, )
+
+    def __str__( self ):
+        return "agent #{}".format( self.token )
+
+    def sells_to( self, another ):
+        return another is not self and ( self.policy is None or self.policy.sells_to_group(
+            self.group, getattr( another, 'group', None )))
+
+    def buys_from( self, another ):
+        return another is not self and ( self.policy is None or self.policy.buys_from_group(
+            self.group, getattr( another, 'group', None )))
+
+
+class market_view( collections.namedtuple( 'market_view', [
+        'name', 'tick', 'lot', 'buying_depth', 'selling_depth' ] )):
+    """A shard's market L2 depth; answers quote just as the market would have."""
+    __slots__			= ()
+
+    def quote( self, amount, side=None, security=None ):
+        """See market.quote."""
+        return quote_depth( self.name, self.tick, self.lot, self.buying_depth, self.selling_depth,
+                            amount, side=side, security=security )
+
+
+def _translate( value, convert ):
+    """Convert the agent of each order in value (an order; or a list, tuple or namedtuple of them, or None)."""
+    if isinstance( value, trade_t ):
+        return value._replace( agent=convert( value.agent ))
+    if isinstance( value, agent_proxy ):
+        return convert( value )
+    if isinstance( value, list ):
+        return [ _translate( v, convert ) for v in value ]
+    if isinstance( value, tuple ):
+        items			= [ _translate( v, convert ) for v in value ]
+        return type( value )( *items ) if hasattr( value, '_fields' ) else tuple( items )
+    return value
+
+
+def _shard( conn, index, shards, name, currency, market_class ):
+    """Run one shard's exchange, performing each batch of (method, args, kwds) calls received, 'til None.
+    Replies w/ a list of each call's (result, exception), w/ each agent_proxy replaced by its token.
+    Besides the exchange's methods, an agent_proxy may be registered, and a market_view taken (for quote).
+
+    The ids of orders entered are allocated by exchange_sharded; when an order instead updates an agent's
+    existing order (which retains its own id), its allocated id is kept as an alias of the retained
+    order's, for cancel and amend, 'til that order is no longer open.
+
+    """
+    exchgs.order_ids		= itertools.count( index + 1 + shards, 2 * shards )	# Disjoint from exchange_sharded.ids
+    exch			= exchange( name, currency=currency, market_class=market_class )
+    proxies			= {}	# { <token>: <agent_proxy> }; one per agent, so agents retain their identity
+    aliases			= {}	# { <id>: ( <security>, <id> ) }; allocated id, and the retained order's
+    local			= lambda agent: proxies[agent.token]
+    token			= lambda agent: agent.token
+    resolve			= lambda id: aliases.get( id, ( None, id ))[1]
+
+    def enter( order, id=None, **kwds ):
+        entered			= exch.enter( order, id=id, **kwds )
+        if id is not None and entered is not None and entered != id:
+            aliases[id]		= order.security,entered
+        return entered
+
+    def enter_many( orders, ids=None, **kwds ):
+        entered			= exch.enter_many( orders, ids=ids, **kwds )
+        for order,id,retained in zip( orders, ids or (), entered ):
+            if retained != id:
+                aliases[id]	= order.security,retained
+        return entered
+
+    def execute_all( **kwds ):
+        trades			= exch.execute_all( **kwds )
+        for id,( security,retained ) in list( aliases.items() ):
+            if retained not in exch.markets[security].order_ids:
+                del aliases[id]
+        return trades
+    calls			= dict(
+        register	= lambda token, group, policy: proxies.__setitem__( token, agent_proxy( token, group, policy )),
+        view		= lambda security: market_view(
+            security, exch.markets[security].tick, exch.markets[security].lot,
+            exch.markets[security].buying_depth, exch.markets[security].selling_depth ),
+        enter		= enter,
+        enter_many	= enter_many,
+        execute_all	= execute_all,
+        cancel		= lambda id: exch.cancel( resolve( id )),
+        amend		= lambda id, *args, **kwds: exch.amend( resolve( id ), *args, **kwds ),
+    )
+    while True:
+        batch			= conn.recv()
+        if batch is None:
+            break
+        results			= []
+        for method,args,kwds in batch:
+            try:
+                call		= calls.get( method ) or getattr( exch, method )
+                result		= call( *_translate( args, local ), **kwds )
+                if isinstance( result, types.GeneratorType ):
+                    result	= list( result )
+                results.append( ( _translate( result, token ), None ))
+            except Exception as exc:
+                results.append( ( None, exc ))
+        conn.send( results )
+    conn.close()
+
+
+class _pickler( pickle.Pickler ):
+    """Pickles each object given an id by persistent( <object> ) (eg. an agent, by its token) as that id."""
+    def __init__( self, file, persistent ):
+        pickle.Pickler.__init__( self, file, pickle.HIGHEST_PROTOCOL )
+        self.persistent		= persistent
+
+    def persistent_id( self, obj ):
+        return self.persistent( obj )
+
+
+class _unpickler( pickle.Unpickler ):
+    """Unpickles each id pickled by a _pickler as the object persistent( <id> )."""
+    def __init__( self, file, persistent ):
+        pickle.Unpickler.__init__( self, file )
+        self.persistent		= persistent
+
+    def persistent_load( self, pid ):
+        return self.persistent( pid )
+
+
+def _dumps( value, persistent ):
+    buf				= io.BytesIO()
+    _pickler( buf, persistent ).dump( value )
+    return buf.getvalue()
+
+
+def _loads( data, persistent ):
+    return _unpickler( io.BytesIO( data ), persistent ).load()
+
+
+def _execute_market( job ):
+    """Execute a market in a pool's worker, from its pickled ( <market class>, <state> ), w/ each agent pickled
+    as its token; the job also carries each token's agent ( <group>, <policy> ), whether to journal
+    the market's order changes, and the execute_all now and kwds.  Returns the market's pickled
+    ( <state>, <trades>, <changes> ), w/ each agent_proxy again pickled as its token.
+
+    """
+    data,agents,journaled,now,kwds = job
+    proxies			= dict( ( token, agent_proxy( token, group, policy ))
+                                for token,( group,policy ) in agents.items() )
+    cls,state			= _loads( data, proxies.__getitem__ )
+    mkt				= cls.__new__( cls )
+    mkt.__dict__.update( state, subscribers=[], relays=(), mirrored=None, snapped=None, snapshots=[],
+                         journal=order_journal() if journaled else None, shared=set() )
+    trades			= mkt.execute_all( now=now, record=False, **kwds )
+    state			= dict( ( k, v ) for k,v in vars( mkt ).items() if k not in _retained )
+    return _dumps( ( state, trades, mkt.journal.changes if journaled else None ),
+                   lambda obj: obj.token if isinstance( obj, agent_proxy ) else None )
+
+
+def execute_pooled( exch, pool, now=None, record=True, **kwds ):
+    """Execute all trade orders in every market of the exchange concurrently, each in a worker of the pool (eg.
+    a multiprocessing.Pool, or a concurrent.futures executor), returning the trades executed; see
+    exchange.execute_all.  Each market's state is sent to a worker, executed there, and returned.
+    Agents (which remain in this process) are represented in the workers by an agent_proxy, as in
+    exchange_sharded, and restored in the markets and trades returned.
+
+    The trades are then settled in a single pass, in market name order (and then in the order each
+    market executed them): each is published to the market's subscribers (and the exchange's), and
+    recorded with each agent (if record); then, each mirrored market's book_mirror is published.
+    The markets' snapshots remain valid, and their diffs include the changes executed.
+
+    """
+    if now is None:
+        now			= timer()
+    agents			= {}	# { <token>: <agent> }
+    tokens			= {}	# { id( <agent> ): <token> }
+
+    def token( obj ):
+        if isinstance( obj, type ) or not hasattr( obj, 'sells_to' ):
+            return None
+        if id( obj ) not in tokens:
+            _compatible( obj )
+            tokens[id( obj )]	= len( agents ) + 1
+            agents[tokens[id( obj )]] = obj
+        return tokens[id( obj )]
+
+    markets			= [ exch.markets[security] for security in sorted( exch.markets ) ]
+    pickled			= []
+    for mkt in markets:
+        state			= dict( ( k, v ) for k,v in vars( mkt ).items() if k not in _retained )
+        pickled.append( _dumps( ( type( mkt ), state ), token ))
+    registered			= dict( ( t, ( getattr( agent, 'group', None ), getattr( agent, 'policy', None )))
+                                for t,agent in agents.items() )
+    results			= pool.map( _execute_market, [
+        ( data, registered, mkt.journal is not None, now, kwds ) for mkt,data in zip( markets, pickled ) ] )
+    executed			= []
+    for mkt,result in zip( markets, results ):
+        state,trades,changes	= _loads( result, agents.__getitem__ )
+        mkt.__dict__.update( state )
+        mkt.shared		= set()	# The books returned are shared w/ no snapshot
+        for change in changes or ():
+            mkt.journal.append( change )
+        executed.append( ( mkt, trades ))
+    settled			= []
+    for mkt,trades in executed:
+        for trade in trades:
+            mkt.publish( trade )
+            if record:
+                for order in trade:
+                    order.agent.record( order )
+            settled.append( trade )
+    for mkt,_ in executed:
+        if mkt.mirrored is not None:
+            mkt.mirrored.publish( mkt )
+    return settled
+
+
+class exchange_sharded( object ):
+    """An exchange w/ its securities' markets partitioned across a number of shard processes (by default, one
+    per CPU), each running its own exchange (of market_class markets), so that their markets are
+    matched concurrently on multiple cores.  Each security is placed on a shard (in turn) when its
+    first order is entered.  Presents much the same interface as an exchange, so it may be used by
+    an engine and its agents unchanged.
+
+    Orders entered (by enter, buy/sell or enter_many), agents' orders closed and agents registered are
+    queued, and sent along w/ the next call that needs that shard's reply (eg. a query of any of its
+    markets, cancel, amend or execute); so, each shard receives all of a cycle's orders in one
+    message.  Each order's id is allocated here as it is queued, from its shard's own stride of ids,
+    so enter returns it at once; an error entering an order (eg. a RuntimeError, for a self-trade) is
+    raised by that later call.  All shards execute concurrently, and their trades are then published
+    to the exchange's subscribers, and recorded with each agent, in a single settlement pass; an
+    error in any queued call is raised only after every trade executed has been yielded (and
+    recorded).
+
+    The results of queries (a market's prices, a market_view of its L2 depth for quote, and an
+    agent's orders) are cached for each shard, 'til a call that may change its books (eg. enter,
+    close or execute) is queued to it.  So, queries always reflect every order entered, and an
+    agent's repeated queries during a cycle are answered w/o a round-trip to any shard whose books
+    it hasn't changed.
+
+    Agents (which remain in this process) are represented in the shards by an agent_proxy, sent to
+    each shard (w/ its group and policy) once, and restored in the orders and trades returned.  An
+    order's id identifies its shard, so cancel and amend are routed directly.  An order entered that
+    updates one of the agent's existing orders is reported (eg. by order_items) by the retained
+    order's id, but its own id may also be used to cancel or amend it, while it remains open.
+
+    """
+    def __init__( self, name, currency=None, market_class=None, shards=None, **kwds ):
+        super( exchange_sharded, self ).__init__( **kwds )
+        self.name		= name
+        self.currency		= currency or ( name.split('/',1)[1] if '/' in name else 'USD' )
+        self.shards		= shards or multiprocessing.cpu_count()
+        self.placement		= {}	# { <security>: <shard> }
+        self.proxies		= {}	# { <agent>: <agent_proxy> }
+        self.agents		= {}	# { <token>: <agent> }
+        self.pending		= [ [] for _ in range( self.shards ) ]	# [ [ ( <method>, <args>, <kwds> ), ... ], ... ]
+        self.cached		= [ {} for _ in range( self.shards ) ]	# [ { ( <method>, <args>... ): <result> }, ... ]
+        self.ids		= [ itertools.count( index + 1, 2 * self.shards )	# Each shard's order ids; see _shard
+                                    for index in range( self.shards ) ]
+        self.subscribers	= []
+        self.connections	= []
+        self.processes		= []
+        for index in range( self.shards ):
+            conn,child		= multiprocessing.Pipe()
+            process		= multiprocessing.Process( target=_shard, args=(
+                child, index, self.shards, name, self.currency, market_class or market ))
+            process.daemon	= True
+            process.start()
+            self.connections.append( conn )
+            self.processes.append( process )
+
+    def shutdown( self ):
+        """Stop all the shard processes (and discard their markets)."""
+        for conn,process in zip( self.connections, self.processes ):
+            conn.send( None )
+            process.join()
+            conn.close()
+        self.connections,self.processes = [],[]
+
+    def _place( self, security, currency=None ):
+        """Return the shard of the security's market, placing it on the next shard if necessary."""
+        if security not in self.placement:
+            currency		= currency or self.currency
+            assert currency == self.currency, \
+                "Unable to enter orders for {} in {}$; only {}$ trades supported".format(
+                    security, currency, self.currency )
+            self.placement[security] = len( self.placement ) % self.shards
+        return self.placement[security]
+
+    def _proxy( self, agent ):
+        """The agent_proxy representing the agent in the shards; registered w/ each shard when first seen."""
+        proxy			= self.proxies.get( agent )
+        if proxy is None:
+            _compatible( agent )
+            proxy = self.proxies[agent] = agent_proxy(
+                len( self.proxies ) + 1, getattr( agent, 'group', None ), getattr( agent, 'policy', None ))
+            self.agents[proxy.token] = agent
+            for index in range( self.shards ):
+                self._queue( index, 'register', proxy.token, proxy.group, proxy.policy )
+        return proxy
+
+    def _queue( self, index, method, *args, **kwds ):
+        if method not in _queries:
+            self.cached[index]	= {}
+        self.pending[index].append( ( method, args, kwds ))
+
+    def _flush( self, indices=None ):
+        """Send each (or the given) shard's pending calls, and then collect their results; returns ( { <shard>:
+        [ <result>, ... ], ... }, <failure> ), w/ the first exception raised by any call (and None as
+        that call's result), or None.  The shards perform their calls concurrently.  Every reply is
+        collected, so the caller may use the results of the calls that succeeded before raising it.
+
+        """
+        sending			= [ index for index in ( range( self.shards ) if indices is None else indices )
+                                    if self.pending[index] ]
+        for index in sending:
+            self.connections[index].send( self.pending[index] )
+            self.pending[index]	= []
+        replies			= {}
+        failure			= None
+        for index in sending:
+            replies[index]	= []
+            for result,exc in self.connections[index].recv():
+                if exc is not None and failure is None:
+                    failure	= exc
+                replies[index].append( _translate( result, self.agents.__getitem__ ))
+        return replies,failure
+
+    def _call( self, index, method, *args, **kwds ):
+        """Perform a call on the shard (after any pending calls), returning its result."""
+        self._queue( index, method, *args, **kwds )
+        replies,failure		= self._flush( [ index ] )
+        if failure is not None:
+            raise failure
+        return replies[index][-1]
+
+    def _broadcast( self, method, *args, **kwds ):
+        """Perform a call on every shard concurrently, returning their results (in shard order), and the first
+        exception raised by any of their calls (or None).
+
+        """
+        for index in range( self.shards ):
+            self._queue( index, method, *args, **kwds )
+        replies,failure		= self._flush()
+        return [ replies[index][-1] for index in range( self.shards ) ],failure
+
+    def _ask( self, queries ):
+        """Return the result of each ( <shard>, <method>, <args> ) query; those not cached are asked of their
+        shards (concurrently), and cached 'til the shard's books may change.
+
+        """
+        asking			= [ ( index, method, args ) for index,method,args in queries
+                                    if ( method, ) + args not in self.cached[index] ]
+        for index,method,args in asking:
+            self._queue( index, method, *args )
+        counts			= collections.Counter( index for index,_,_ in asking )
+        replies,failure		= self._flush( sorted( counts ))
+        if failure is not None:
+            raise failure
+        answers			= dict( ( index, iter( replies[index][-count:] )) for index,count in counts.items() )
+        for index,method,args in asking:
+            self.cached[index][( method, ) + args] = next( answers[index] )
+        return [ self.cached[index][( method, ) + args] for index,method,args in queries ]
+
+    def format_book( self, width=40, orders=False ):
+        """Print each market's order book price levels (or every order); see market.format_book."""
+        books,failure		= self._broadcast( 'format_book', width=width, orders=orders )
+        if failure is not None:
+            raise failure
+        return "\n".join( book for book in books if book )
+
+    def close( self, agent, security=None ):
+        """Close all open orders for the agent, in all markets (or in market matching security)."""
+        if security is not None:
+            if security in self.placement:
+                self._queue( self.placement[security], 'close', self._proxy( agent ), security=security )
+            return
+        for index in range( self.shards ):
+            self._queue( index, 'close', self._proxy( agent ))
+
+    def orders( self, agent, security=None ):
+        """Yields all open orders for the agent, in all markets (or in market matching security)."""
+        for _,order in self.order_items( agent, security=security ):
+            yield order
+
+    def order_items( self, agent, security=None ):
+        """Yield the ( <id>, <trade_t> ) of each open order for the agent, as orders."""
+        if security is None:
+            indices		= range( self.shards )
+        else:
+            indices		= [ self.placement[security] ] if security in self.placement else []
+        proxy			= self._proxy( agent )
+        for opened in self._ask( [ ( index, 'order_items', ( proxy, )) for index in indices ] ):
+            for id,order in opened:
+                if security is None or order.security == security:
+                    yield id,order
+
+    def buy( self, agent, amount, price=None, security=None, now=None, update=True, tif=None ):
+        assert security, "Must specify security to buy on exchange"
+        return self.enter( trade_t( security, price, self.currency, timer() if now is None else now,  amount, agent ),
+                           update=update, tif=tif )
+
+    def sell( self, agent, amount, price=None, security=None, now=None, update=True, tif=None ):
+        assert security, "Must specify security to sell on exchange"
+        return self.enter( trade_t( security, price, self.currency, timer() if now is None else now, -amount, agent ),
+                           update=update, tif=tif )
+
+    def enter( self, order, update=True, tif=None ):
+        """Queue the trade order for entry in its security's market (see exchange.enter), returning the id
+        allocated to it.
+
+        """
+        index			= self._place( order.security, order.currency )
+        id			= next( self.ids[index] )
+        self._queue( index, 'enter', order._replace( agent=self._proxy( order.agent )),
+                     update=update, tif=tif, id=id )
+        return id
+
+    def enter_many( self, orders, update=True, tif=None ):
+        """Queue many trades for entry in their markets (see exchange.enter_many), returning the ids allocated
+        to the orders (in order); each shard's are sent together.
+
+        """
+        shards			= collections.OrderedDict()
+        ids			= []
+        for order in orders:
+            index		= self._place( order.security, order.currency )
+            ids.append( next( self.ids[index] ))
+            entering,allocated	= shards.setdefault( index, ( [], [] ))
+            entering.append( order._replace( agent=self._proxy( order.agent )))
+            allocated.append( ids[-1] )
+        for index,( entering,allocated ) in shards.items():
+            self._queue( index, 'enter_many', entering, update=update, tif=tif, ids=allocated )
+        return ids
+
+    def cancel( self, id ):
+        """Cancel the open order with the given id, in its shard; see market.cancel."""
+        return self._call( ( id - 1 ) % self.shards, 'cancel', id )
+
+    def amend( self, id, amount, price=UNCHANGED, now=None ):
+        """Amend the open order with the given id, in its shard; see market.amend."""
+        return self._call( ( id - 1 ) % self.shards, 'amend', id, amount, price=price, now=now )
+
+    def execute( self, now=None, **kwds ):
+        """Execute every shard's markets concurrently, and yield all the resultant trades (in shard order).  If
+        any call failed (eg. one queued before the execute), the first error is raised only after every
+        trade executed (by the shards whose execute succeeded) has been yielded.
+
+        """
+        if now is None:
+            now			= timer()
+        executed,failure	= self._broadcast( 'execute_all', now=now, record=False, **kwds )
+        for trade in itertools.chain( *( trades or () for trades in executed )):
+            for sub in self.subscribers:
+                sub.publish( trade )
+            yield trade
+        if failure is not None:
+            raise failure
+
+    def execute_all( self, now=None, record=True, **kwds ):
+        """Execute all trade orders in every market (see exchange.execute_all), returning the trades executed.
+        The shards are executed concurrently.
+
+        """
+        trades			= []
+        for trade in self.execute( now=now, **kwds ):
+            if record:
+                for order in trade:
+                    order.agent.record( order )
+            trades.append( trade )
+        return trades
+
+    def price( self, security ):
+        return self.prices( [ security ] )[0]
+
+    def prices( self, securities ):
+        """Return the prices_t of each of the securities, in order; the shards are asked concurrently."""
+        placed			= [ security for security in securities if security in self.placement ]
+        prices			= dict( zip( placed, self._ask( [ ( self.placement[security], 'price', ( security, ))
+                                                             for security in placed ] )))
+        return [ prices[security] if security in prices else prices_t( None, None, None ) for security in securities ]
+
+    def quote( self, security, amount, side=None ):
+        """Return the quote_t to buy/sell amount of the security; see market.quote."""
+        if security in self.placement:
+            view,		= self._ask( [ ( self.placement[security], 'view', ( security, )) ] )
+            return view.quote( amount, side=side )
+        return quote_t( None, None, 0 )
+
+    def subscribe( self, callback=None, maxlen=1000, block=False ):
+        """Subscribe to the trades of all markets; see market.subscribe."""
+        sub			= subscription( callback=callback, maxlen=maxlen, block=block )
+        self.subscribers.append( sub )
+        return sub
+
+    def unsubscribe( self, sub ):
+        """Remove (and close) the subscription."""
+        self.subscribers.remove( sub )
+        sub.close()
@@ -1,6 +1,13 @@
 from __future__ import absolute_import, print_function, division
 
 import logging
+import math
+import multiprocessing
+import pickle
+import random
+
+import pytest
+
 from . import trading, near
 
 
@@ -214,3 +221,1205 @@ def test_exchange():
         for order in ( trade for trade in GSE.execute( now=t )):
             order.agent.record( order )
         logging.info( "GSE after %d:\n%s" % ( t , repr( GSE )))
+
+
+def random_orders( count, agents=None, seed=0 ):
+    """Generate a repeatable sequence of random buy/sell trade_t orders, incl. market-price orders
+    and orders with identical prices and times.  By default, every order is by a unique agent.
+
+    """
+    rnd			= random.Random( seed )
+    for i in range( count ):
+        price		= None if rnd.random() < .1 else round( rnd.uniform( 9.9, 10.1 ), 2 )
+        amount		= rnd.randint( 1, 100 ) * ( 1 if rnd.random() < .5 else -1 )
+        agent		= "agent {}".format( i if agents is None else rnd.randrange( agents ))
+        yield trading.trade_t( "grain", price, "USD", rnd.randint( 0, count // 4 ), amount, agent )
+
+
+# The market classes that must behave as the reference market; the columnar and auction markets require NumPy
+needs_numpy			= pytest.mark.skipif( trading.columnar.numpy is None, reason="requires NumPy" )
+columnar			= pytest.param( trading.market_columnar, marks=needs_numpy )
+auction				= pytest.param( trading.market_auction, marks=needs_numpy )
+
+
+def markets( *classes ):
+    """Run the test once for each market class (by default, the continuous markets), as cls."""
+    return pytest.mark.parametrize( "cls", classes or ( trading.market, trading.market_sorted, columnar ))
+
+
+def entered( cls, orders, update=None, **kwds ):
+    """A new cls market in grain, w/ the orders entered one at a time; any refused as self-crossing are skipped."""
+    m			= cls( "grain", **kwds )
+    for order in orders:
+        try:
+            m.enter( order, update=update )
+        except RuntimeError:
+            pass
+    return m
+
+
+def test_market_sorted():
+    """A market_sorted must maintain exactly the same books, and execute the same trades, as the reference
+    market.
+
+    """
+    ref			= trading.market( "grain" )
+    srt			= trading.market_sorted( "grain" )
+    for order in random_orders( 500 ):
+        ref.enter( order )
+        srt.enter( order )
+    assert list( ref.buying ) == list( srt.buying )
+    assert list( ref.selling ) == list( srt.selling )
+
+    assert list( ref.execute( now=1000 )) == list( srt.execute( now=1000 ))
+    assert list( ref.orders() ) == list( srt.orders() )
+    assert ref.price() == srt.price()
+
+    GSE			= trading.exchange( "GSE", market_class=trading.market_sorted )
+    GSE.enter( trading.trade_t( "grain", 10., "USD", 1., 100, "agent A" ))
+    assert isinstance( GSE.markets["grain"].buying, trading.sorted_book )
+
+
+@markets()
+def test_market_agent_orders( cls ):
+    """The agent_orders index must track each agent's open orders through entry, fills and close."""
+    m			= entered( cls, random_orders( 300, agents=20 ), update=True )
+    trades		= list( m.execute( now=1000 ))
+    assert trades
+    for agent,opened in m.agent_orders.items():
+        assert opened
+        assert sorted( map( id, opened )) == sorted( id( order ) for order in list( m.buying ) + list( m.selling )
+                                                     if order.agent == agent )
+    assert sum( len( opened ) for opened in m.agent_orders.values() ) == len( list( m.orders() ))
+
+    agent		= next( iter( m.agent_orders ))
+    opened		= list( m.orders( agent ))
+    m.close( agent )
+    assert agent not in m.agent_orders
+    assert not any( order.agent == agent for order in m.orders() )
+    assert not any( order in opened for order in m.orders() )
+
+
+@needs_numpy
+def test_market_columnar():
+    """A market_columnar must yield exactly the same trades as the reference market, and leave the same
+    books, incl. market-price orders, partial fills and prices.
+
+    """
+    for seed in range( 5 ):
+        # Whole runs of trades are settled at once; but not when re-scanning after each trade, nor for
+        # fractional amounts.  Fills are accounted for (and snapshotted orders unshared) exactly as
+        # by the reference market.
+        rescan		= True if seed == 3 else None
+        ref		= trading.market( "grain", rescan=rescan )
+        col		= trading.market_columnar( "grain", rescan=rescan )
+        for order in random_orders( 1000, seed=seed ):
+            if seed == 4:
+                order	= order._replace( amount=order.amount / 3 )
+            ref.enter( order )
+            col.enter( order )
+        assert ref.price() == col.price()
+        snapshots	= ( ref.snapshot(), col.snapshot() ) if seed % 2 else None
+        assert list( ref.execute( now=1000 )) == list( col.execute( now=1000 ))
+        assert list( ref.buying ) == list( col.buying )
+        assert list( ref.selling ) == list( col.selling )
+        assert ref.price() == col.price()
+        assert ref.quote( 500 ) == col.quote( 500 ) and ref.quote( -500 ) == col.quote( -500 )
+        assert ( ref.ages.count, ref.ages.total, ref.waits.count ) == ( col.ages.count, col.ages.total, col.waits.count )
+        assert len( ref.order_ids ) == len( col.order_ids ) and ref.agent_best.keys() == col.agent_best.keys()
+        if snapshots:
+            assert list( snapshots[0].orders() ) == list( snapshots[1].orders() )
+
+    # Self-trades are detected from the agent_best index
+    col			= trading.market_columnar( "grain" )
+    col.sell( "agent A", 10, 4.00, now=1. )
+    col.sell( "agent B", 10, 3.90, now=1. )
+    try:
+        col.buy( "agent A", 10, 4.05, now=2. )
+        assert False, "Should have detected self-trade"
+    except RuntimeError:
+        pass
+    col.buy( "agent A", 10, 3.95, now=2. )
+    assert len( col.buying ) == 1
+
+
+@needs_numpy
+def test_market_auction():
+    """A batch auction clears at the single price maximizing volume, filling in price-time priority."""
+    m			= trading.market_auction( "grain" )
+    m.buy(  "agent A", 100, 10.0, now=1. )
+    m.buy(  "agent B", 100,  9.0, now=1. )
+    m.sell( "agent C",  50,  8.0, now=2. )
+    m.sell( "agent D", 100,  9.5, now=2. )
+    m.sell( "agent E",  50, 11.0, now=2. )
+    assert m.clearing() == ( 9.5, 100 )
+    trades		= m.execute_all( now=3., record=False )
+    assert [ ( b.agent, s.agent, b.amount, b.price ) for b,s in trades ] == [
+        ( "agent A", "agent C", 50, 9.5 ),
+        ( "agent A", "agent D", 50, 9.5 ) ]
+    assert [ o.amount for o in m.buying ] == [ 100 ]
+    assert [ o.amount for o in m.selling ] == [ -50, -50 ]
+
+    # Agents' sells_to/buys_from restrictions are respected; the picky buyer skips the best seller
+    class picky( trading.agent ):
+        def buys_from( self, another ):
+            return another.identity != "cheap"
+    a,b,c		= picky( "picky" ),trading.agent( "cheap" ),trading.agent( "dear" )
+    m			= trading.market_auction( "grain" )
+    m.buy(  a, 10, 10.0, now=1. )
+    m.sell( b, 10,  9.0, now=2. )
+    m.sell( c, 10,  9.5, now=2. )
+    m.buy(  trading.agent( "market" ), 5, None, now=3. )
+    trades		= m.execute_all( now=4. )
+    assert sorted( ( str( bt.agent ), str( st.agent ), bt.amount ) for bt,st in trades ) == [
+        ( "market", "cheap", 5 ), ( "picky", "dear", 10 ) ]
+    assert all( bt.price == trades[0][0].price for bt,st in trades )
+    assert a.assets["grain"] == 10
+
+    # Sellers passed over by one buyer remain candidates for the next; a rejected pair is examined once
+    class counted( trading.market_auction ):
+        calls		= 0
+        def agents_compatible( self, buyer, seller ):
+            self.calls	       += 1
+            return super( counted, self ).agents_compatible( buyer, seller )
+    m			= counted( "grain" )
+    for t in range( 50 ):
+        m.sell( b, 1, 9.0, now=t )
+        m.buy( a, 1, 10.0, now=t )
+    m.sell( c, 40, 9.5, now=50. )
+    m.buy( trading.agent( "any" ), 20, 10.0, now=51. )
+    m.calls		= 0
+    trades		= m.execute_all( now=52. )
+    assert sorted( set( ( str( bt.agent ), str( st.agent )) for bt,st in trades )) == [
+        ( "any", "cheap" ), ( "picky", "dear" ) ]
+    assert sum( bt.amount for bt,_ in trades ) == 60
+    assert m.calls == len( trades ) + 1	# One per trade, and one rejection; not one per seller passed over
+
+
+@markets()
+def test_market_depth( cls ):
+    """The aggregate price levels must track the books through entry, fills and close."""
+    def levels( book ):
+        result		= {}
+        for order in book:
+            key		= None if trading.non_value( order.price ) else order.price
+            amount,count = result.get( key, ( 0, 0 ))
+            result[key]	= ( amount + abs( order.amount ), count + 1 )
+        return result
+
+    m			= entered( cls, random_orders( 300, agents=20 ), update=True )
+    list( m.execute( now=1000 ))
+    m.close( "agent 3" )
+    for book,dep in ( ( m.buying, m.buying_depth ), ( m.selling, m.selling_depth )):
+        assert { l.price: ( l.amount, l.count ) for l in dep } == levels( book )
+        assert dep.prices == sorted( dep.prices )
+    bid,ask,_		= m.price()
+    assert bid == [ o for o in m.buying if not trading.non_value( o.price ) ][-1]
+    assert ask == [ o for o in m.selling if not trading.non_value( o.price ) ][0]
+    assert type( bid ) is trading.trade_t and type( ask ) is trading.trade_t	# Not the resting order_t
+    assert len( m.format_book().split( '\n' )) == sum( 1 for _ in m.buying_depth ) + sum( 1 for _ in m.selling_depth )
+    assert len( m.format_book( orders=True ).split( '\n' )) == len( m.buying ) + len( m.selling )
+
+
+def test_depth_ticks():
+    """A depth of whole ticks fills exactly as one indexed by level, and its Fenwick trees (indexed by tick) are
+    not rebuilt as price levels within their range appear and disappear.
+
+    """
+    rnd			= random.Random( 1 )
+    ref,tck		= trading.depth(),trading.depth( ticks=True )
+    opened		= []
+    for _ in range( 2000 ):
+        if opened and rnd.random() < .45:
+            price,amount = opened.pop( rnd.randrange( len( opened )))
+            ref.change( price, -amount, -1 )
+            tck.change( price, -amount, -1 )
+        else:
+            price,amount = rnd.randint( 950, 1050 ),rnd.randint( 1, 50 )
+            opened.append( ( price, amount ))
+            ref.change( price, amount, 1 )
+            tck.change( price, amount, 1 )
+        want		= rnd.randint( 0, 600 )
+        assert ref.fill( want ) == tck.fill( want )
+        assert ref.fill( want, descending=True ) == tck.fill( want, descending=True )
+    assert tck.base is not None and ref.base is None
+    trees		= tck.cumulative
+    for price in ( 949, 1051 ):
+        tck.change( price, 10, 1 )
+        assert tck.fill( 10 ) and tck.cumulative is trees
+        tck.change( price, -10, -1 )
+    tck.change( tck.base - 1, 10, 1 )
+    assert tck.fill( 10 ) == ( 10, 10 * tck.prices[0], tck.prices[0] ) and tck.cumulative is not trees
+
+
+def test_market_queues():
+    """A sorted_book's queue of market-price orders must index, iterate and fill exactly as the reference
+    book, even when many orders are at market price (including ties in time).
+
+    """
+    orders		= [ order._replace( price=None ) if i % 3 == 0 else order
+                            for i,order in enumerate( random_orders( 600 )) ]
+    for key in ( trading.buy_book_key, trading.sell_book_key ):
+        ref		= trading.book( key=key )
+        srt		= trading.sorted_book( key=key )
+        for order in orders:
+            if ( order.amount < 0 ) == ( key is trading.sell_book_key ):
+                ref.insert_order( order )
+                srt.insert_order( order )
+        assert srt.queue and list( ref ) == list( srt ) and list( reversed( ref )) == list( reversed( srt ))
+        assert all( ref[i] is srt[i] for i in range( -len( ref ), len( ref )))
+        for index in ( 0, -1, len( ref ) // 2, 0, -1 ):
+            del ref[index]
+            del srt[index]
+            assert list( ref ) == list( srt )
+        ref.remove_order( ref[3] )
+        srt.remove_order( srt[3] )
+        assert list( ref ) == list( srt ) and srt.queued == len( srt.queue )
+        for index in ( len( srt ), -len( srt ) - 1 ):
+            with pytest.raises( IndexError ):
+                srt[index]
+        empty		= trading.sorted_book( key=key )
+        for index in ( 0, -1 ):
+            with pytest.raises( IndexError ):
+                empty[index]
+
+    ref			= trading.market( "grain" )
+    srt			= trading.market_sorted( "grain" )
+    for order in orders:
+        ref.enter( order )
+        srt.enter( order )
+    assert list( ref.execute( now=1000 )) == list( srt.execute( now=1000 ))
+    assert list( ref.orders() ) == list( srt.orders() )
+    assert ref.price() == srt.price()
+
+
+def test_sorted_book_blocks():
+    """A sorted_book's orders are held in blocks; a copy shares them, and each copies only the blocks it alters."""
+    size		= trading.blocks.size
+    trading.blocks.size	= 4
+    try:
+        for key in ( trading.buy_book_key, trading.sell_book_key ):
+            orders	= [ o for o in random_orders( 300 ) if ( o.amount < 0 ) == ( key is trading.sell_book_key ) ]
+            ref		= trading.book( key=key )
+            srt		= trading.sorted_book( key=key )
+            for order in orders:
+                ref.insert_order( order )
+                srt.insert_order( order )
+            assert len( srt.orders.items ) > 10 and all( len( b ) <= 8 for b in srt.orders.items )
+            assert list( ref ) == list( srt ) and list( reversed( ref )) == list( reversed( srt ))
+            assert all( ref[i] is srt[i] for i in range( -len( ref ), len( ref )))
+
+            # A copy shares every block; altering either copies only the block altered
+            shared	= list( srt )
+            copy	= srt.copy()
+            assert all( a is b for a,b in zip( copy.orders.items, srt.orders.items ))
+            for index in ( 0, -1, len( ref ) // 2, len( ref ) // 3 ):
+                del ref[index]
+                del copy[index]
+            ref.remove_order( ref[5] )
+            copy.remove_order( copy[5] )
+            tied	= ref[7]._replace( agent="agent tied" )		# Equal key; entered after ref[7]
+            ref.insert_order( tied )
+            copy.insert_order( tied )
+            assert list( ref ) == list( copy ) and list( srt ) == shared
+            assert sum( a is not b for a,b in zip( copy.orders.items, srt.orders.items )) <= 8
+            copy.insert_orders( orders[:20] )
+            ref.insert_orders( orders[:20] )
+            assert list( ref ) == list( copy ) and list( srt ) == shared
+    finally:
+        trading.blocks.size = size
+
+
+def test_market_grouped():
+    """A market_grouped must execute the same trades as the reference market, while examining far fewer
+    buyer/seller pairs when most buyers refuse to deal with some group of sellers (eg. a reserve).
+
+    """
+    class reserve( trading.agent ):
+        group		= "reserve"
+
+    class public( trading.agent ):
+        group		= "public"
+        def buys_from_group( self, group ):
+            return group != "reserve"
+
+    class member( trading.agent ):
+        group		= "member"
+
+    def counting( cls ):
+        class counted( cls ):
+            calls	= 0
+            def compatible( self, buyer, seller ):
+                self.calls     += 1
+                return super( counted, self ).compatible( buyer, seller )
+        return counted
+
+    rnd			= random.Random( 0 )
+    reserves		= [ reserve( "reserve {}".format( i )) for i in range( 5 ) ]
+    publics		= [ public( "public {}".format( i )) for i in range( 50 ) ]
+    members		= [ member( "member {}".format( i )) for i in range( 5 ) ]
+    orders		= []
+    for t in range( 400 ):
+        # The reserve sells cheapest; most buyers (the public) won't buy from it.
+        orders.append( trading.trade_t( "grain", round( rnd.uniform( 9.0, 9.5 ), 2 ), "USD", t,
+                                        -rnd.randint( 1, 100 ), rnd.choice( reserves )))
+        orders.append( trading.trade_t( "grain", round( rnd.uniform( 9.9, 10.1 ), 2 ), "USD", t,
+                                        -rnd.randint( 1, 100 ), rnd.choice( publics + members )))
+        buyer		= rnd.choice( publics ) if rnd.random() < .95 else rnd.choice( members )
+        orders.append( trading.trade_t( "grain", None if rnd.random() < .1 else round( rnd.uniform( 9.9, 10.1 ), 2 ),
+                                        "USD", t, rnd.randint( 1, 100 ), buyer ))
+    ref			= counting( trading.market )( "grain" )
+    grp			= counting( trading.market_grouped )( "grain" )
+    for order in orders:
+        ref.enter( order )
+        grp.enter( order )
+    ref.calls = grp.calls	= 0	# Count only the calls while executing
+    ref_trades		= list( ref.execute( now=1000 ))
+    grp_trades		= list( grp.execute( now=1000 ))
+    assert ref_trades == grp_trades
+    assert any( buy.agent in members and sell.agent in reserves for buy,sell in grp_trades )
+    assert list( ref.orders() ) == list( grp.orders() )
+    assert grp.calls * 10 < ref.calls
+
+    # Each group's index follows its orders in book order, as they are entered, filled, amended and removed
+    def booked( index ):
+        return [ grp.order_ids[entry[-1]] for entry in sorted( e for _,entries in index.values() for e in entries ) ]
+    assert booked( grp.sellers ) == list( grp.selling ) and booked( grp.buyers ) == list( reversed( grp.buying ))
+    for m in ( ref, grp ):
+        for i,( id,order ) in enumerate( list( m.order_items() )[::7] ):
+            m.amend( id, order.amount // 2, now=order.time ) if i % 2 else m.cancel( id )
+        m.enter( trading.trade_t( "grain", 9.2, "USD", 2000, 50, members[0] ))	# Buys from the reserve
+    assert list( ref.execute( now=2000 )) == list( grp.execute( now=2000 ))
+    assert booked( grp.sellers ) == list( grp.selling ) and booked( grp.buyers ) == list( reversed( grp.buying ))
+    assert len( grp.entries ) == len( grp.order_ids )
+
+
+def test_market_order_t():
+    """Resting orders are mutable order_t records, filled in place; trade_t fills are yielded."""
+    m			= trading.market( "grain" )
+    m.buy( "agent A", 100, 10., now=1. )
+    m.sell( "agent B", 30, 9., now=2. )
+    m.sell( "agent C", 20, 9.5, now=3. )
+    resting		= m.buying[-1]
+    assert isinstance( resting, trading.order_t )
+    assert resting == trading.trade_t( "grain", 10., "USD", 1., 100, "agent A" )
+    trades		= list( m.execute( now=4. ))
+    assert all( type( order ) is trading.trade_t for trade in trades for order in trade )
+    assert [ buy.amount for buy,_ in trades ] == [ 30, 20 ]
+    assert m.buying[-1] is resting and resting.amount == 50
+    assert list( m.orders( "agent A" )) == [ trading.trade_t( "grain", 10., "USD", 1., 50, "agent A" ) ]
+    assert str( resting ) == str( resting.trade() )
+    assert tuple( resting._replace( amount=1 )) == ( "grain", 10., "USD", 1., 1, "agent A" )
+
+    # Callers get immutable trade_t orders and prices (hashable, orderable namedtuples), and ids apart
+    m.sell( "agent D", 10, 11., now=5. )
+    assert all( type( order ) is trading.trade_t for order in m.orders() )
+    assert sorted( m.orders() ) and len( set( m.orders() )) == 2 and hash( m.price() )
+    assert m.price().bid._asdict()["amount"] == 50
+    assert dict( m.order_items( "agent A" )) == { resting.id: resting.trade() }
+
+
+@markets()
+def test_market_matches( cls ):
+    """Entering an order that crosses one of the agent's own orders must be refused, exactly when some own
+    opposing order would be crossed; agent_best must track each agent's best open orders.
+
+    """
+    def crosses( m, order ):
+        for other in m.orders( order.agent ):
+            if ( other.amount < 0 ) == ( order.amount < 0 ):
+                continue
+            if trading.non_value( other.price ) or trading.non_value( order.price ):
+                return True
+            if ( other.price <= order.price ) if order.amount > 0 else ( other.price >= order.price ):
+                return True
+        return False
+
+    m			= cls( "grain" )
+    refused		= 0
+    for order in random_orders( 600, agents=30 ):
+        expected	= crosses( m, order )
+        try:
+            m.enter( order )
+            assert not expected
+        except RuntimeError:
+            assert expected
+            refused            += 1
+    assert refused
+    list( m.execute( now=1000 ))
+    m.close( "agent 3" )
+    assert set( m.agent_best ) == set( m.agent_orders )
+    for agent,( bid,ask ) in m.agent_best.items():
+        bids		= [ o for o in m.buying if o.agent == agent ]
+        asks		= [ o for o in m.selling if o.agent == agent ]
+        assert bid is ( bids[-1] if bids else None )
+        assert ask is ( asks[0] if asks else None )
+
+
+@markets()
+def test_market_enter_many( cls ):
+    """Entering many orders at once must leave exactly the same books as entering them one at a time."""
+    orders		= list( random_orders( 600 ))
+    one			= cls( "grain" )
+    many		= cls( "grain" )
+    for order in orders[:300]:
+        one.enter( order )
+    many.enter_many( orders[:300] )
+    for order in orders[300:]:
+        one.enter( order )
+    many.enter_many( orders[300:] )
+    assert list( one.buying ) == list( many.buying )
+    assert list( one.selling ) == list( many.selling )
+    assert list( one.execute( now=1000 )) == list( many.execute( now=1000 ))
+    assert list( one.orders() ) == list( many.orders() )
+
+    # A self-crossing order is refused, after entering the orders preceding it
+    m			= cls( "grain" )
+    try:
+        m.enter_many( [ trading.trade_t( "grain", 10., "USD", 1.,  10, "agent A" ),
+                        trading.trade_t( "grain",  9., "USD", 2., -10, "agent A" ),
+                        trading.trade_t( "grain",  9., "USD", 3., -10, "agent B" ) ] )
+        assert False, "Should have detected self-trade"
+    except RuntimeError:
+        pass
+    assert list( m.orders() ) == [ trading.trade_t( "grain", 10., "USD", 1.,  10, "agent A" ) ]
+
+    # Updating closes each agent's prior orders once; all its new orders remain
+    m.enter_many( [ trading.trade_t( "grain", 9.5, "USD", 4., 10, "agent A" ),
+                    trading.trade_t( "grain", 9.6, "USD", 5., 10, "agent A" ) ], update=True )
+    assert [ order.price for order in m.orders( "agent A" ) ] == [ 9.5, 9.6 ]
+
+
+def test_exchange_enter_many():
+    """An exchange enters many orders in each security's market, creating them as necessary."""
+    GSE			= trading.exchange( "GSE" )
+    GSE.enter_many( [ trading.trade_t( "grain", 10., "USD", 1.,  10, "agent A" ),
+                      trading.trade_t( "corn",   5., "USD", 1., -10, "agent A" ) ] )
+    GSE.sell( "agent B", 10, 11., security="grain", now=2. )
+    assert sorted( GSE.markets ) == [ "corn", "grain" ]
+    assert [ order.amount for order in GSE.orders( "agent B" ) ] == [ -10 ]
+
+
+@markets()
+def test_market_amend( cls ):
+    """Orders have stable ids; unchanged updates are skipped, and changed ones amend the single order."""
+    m			= entered( cls, random_orders( 200 ))
+    a			= m.enter( trading.trade_t( "grain", 10.,  "USD", 1.,  10, "agent A" ), update=True )
+    resting		= m.order_ids[a]
+    assert m.enter( trading.trade_t( "grain", 10.,  "USD", 2.,  10, "agent A" ), update=True ) == a
+    assert m.order_ids[a] is resting and resting.time == 1.
+    assert m.enter( trading.trade_t( "grain", 10.5, "USD", 3.,  10, "agent A" ), update=True ) == a
+    assert list( m.orders( "agent A" )) == [ trading.trade_t( "grain", 10.5, "USD", 3., 10, "agent A" ) ]
+    assert m.amend( a, 20, price=10.5, now=4. ) == a
+    assert [ o.amount for o in m.buying if o.agent == "agent A" ] == [ 20 ]
+    assert m.amend( a, 15, now=4.5 ) == a	# amount only; remains a limit order at its price
+    assert list( m.orders( "agent A" )) == [ trading.trade_t( "grain", 10.5, "USD", 4.5, 15, "agent A" ) ]
+    assert m.amend( a, 20, now=4.5 ) == a
+    assert m.amend( a, 20, price=None, now=5. ) == a
+    assert m.buying_depth.market[0] >= 20 and m.agent_best["agent A"][0].price is None
+
+    # The amended order is where a new order would have been entered
+    ref			= cls( "grain" )
+    for order in m.orders():
+        ref.enter( order )
+    assert list( ref.buying ) == list( m.buying ) and list( ref.selling ) == list( m.selling )
+    assert list( ref.execute( now=1000 )) == list( m.execute( now=1000 ))
+
+    b			= m.enter( trading.trade_t( "grain", 99., "USD", 6., -10, "agent B" ))
+    assert m.cancel( b ).agent == "agent B"
+    assert m.cancel( b ) is None and "agent B" not in m.agent_orders
+    c			= m.enter( trading.trade_t( "grain", 99., "USD", 7., -10, "agent C" ))
+    assert m.amend( c, 0 ) is None and c not in m.order_ids
+
+
+def test_exchange_amend():
+    """An exchange amends and cancels orders by id, in whichever market they are open."""
+    GSE			= trading.exchange( "GSE" )
+    GSE.enter( trading.trade_t( "corn", 5., "USD", 1., 10, "agent A" ))
+    d			= GSE.enter( trading.trade_t( "grain", 10., "USD", 1., 10, "agent A" ))
+    assert GSE.amend( d, 5, now=2. ) == d
+    assert list( GSE.orders( "agent A", security="grain" )) == [ trading.trade_t( "grain", 10., "USD", 2., 5, "agent A" ) ]
+    assert GSE.cancel( d ) is not None and not list( GSE.orders( "agent A", security="grain" ))
+
+
+@markets( trading.market, trading.market_sorted, columnar, auction )
+def test_market_tif( cls ):
+    """Good-till-time orders are cancelled by the first execute at/after their time; IOC orders after the
+    next execute; GTC orders remain.
+
+    """
+    m			= cls( "grain" )
+    gtc			= m.buy(  "agent A", 10, 9.0, now=1. )
+    gtt			= m.buy(  "agent B", 10, 9.1, now=1., tif=5. )
+    ioc			= m.sell( "agent C", 20, 9.1, now=2., tif=trading.IOC )
+    trades		= list( m.execute( now=3. ))
+    assert [ ( buy.agent, buy.amount ) for buy,_ in trades ] == [ ( "agent B", 10 ) ]
+    assert gtt not in m.order_ids and ioc not in m.order_ids and gtc in m.order_ids
+
+    gtt			= m.buy(  "agent B", 10, 8.0, now=4., tif=5. )
+    assert m.buy( "agent B", 10, 8.0, now=4.5, update=True, tif=6. ) == gtt # unchanged, but extended
+    for _ in range( 10 ):
+        assert m.buy( "agent B", 10, 8.0, now=4.5, update=True, tif=6. ) == gtt # unchanged, not re-queued
+    assert sorted( e for e in m.expiries if e[1] == gtt ) == [ ( 5., gtt ), ( 6., gtt ) ] # superseded, current
+    assert not list( m.execute( now=5. )) and gtt in m.order_ids
+    assert not list( m.execute( now=6. )) and gtt not in m.order_ids
+    assert list( m.orders() ) == [ trading.trade_t( "grain", 9.0, "USD", 1., 10, "agent A" ) ]
+    assert not m.expiries and not m.order_tif and not m.immediate
+
+    ioc			= m.sell( "agent C", 10, 9.5, now=7., tif=trading.IOC )
+    for _ in range( 10 ):
+        assert m.sell( "agent C", 10, 9.5, now=7., update=True, tif=trading.IOC ) == ioc
+    assert m.immediate == [ ioc ]
+    assert not list( m.execute( now=8. )) and ioc not in m.order_ids and not m.immediate
+
+
+def test_market_resume():
+    """Resuming the walk for compatible agents after each trade (instead of re-walking from the top of the
+    books) must yield exactly the same trades, for each rescan setting; and, in the worst case for a
+    re-walk, check an order of magnitude fewer agent pairs.
+
+    """
+    class picky( trading.agent ):
+        def buys_from( self, another ):
+            return super( picky, self ).buys_from( another ) and not str( another ).startswith( "seller" )
+
+    class rewalk( trading.market ):
+        calls		= 0
+        def compatible( self, buyer, seller ):
+            self.calls	       += 1
+            return super( rewalk, self ).compatible( buyer, seller )
+        @staticmethod
+        def resume_step( path, bid=None, ask=None ):
+            return 0
+
+    class resume( rewalk ):
+        resume_step	= staticmethod( trading.market.resume_step )
+
+    rnd			= random.Random( 0 )
+    sellers		= [ trading.agent( "seller {}".format( i )) for i in range( 10 ) ]
+    buyers		= [ picky( "buyer {}".format( i )) for i in range( 40 ) ] \
+                          + [ trading.agent( "member {}".format( i )) for i in range( 5 ) ]
+    orders		= []
+    for t in range( 300 ):
+        if t % 10 == 0:
+            orders.append( trading.trade_t( "grain", round( rnd.uniform( 9.0, 9.5 ), 2 ), "USD", t,
+                                            -rnd.randint( 1000, 5000 ), rnd.choice( sellers )))
+        orders.append( trading.trade_t( "grain", None if rnd.random() < .1 else round( rnd.uniform( 9.4, 10.1 ), 2 ),
+                                        "USD", t, rnd.randint( 1, 100 ), rnd.choice( buyers )))
+    for rescan in ( None, True, False ):
+        ref		= rewalk( "grain", rescan=rescan )
+        res		= resume( "grain", rescan=rescan )
+        ref.enter_many( orders )
+        res.enter_many( orders )
+        ref.calls = res.calls	= 0
+        trades		= list( res.execute( now=1000 ))
+        assert trades and trades == list( ref.execute( now=1000 ))
+        assert list( ref.orders() ) == list( res.orders() )
+
+    # The worst case for a re-walk: a seller under a long run of K incompatible buyers, above T small
+    # compatible buyers.  Re-walking after each of the T trades checks O(T*K) pairs; resuming, O(T+K).
+    orders		= [ trading.trade_t( "grain", 9., "USD", 0, -10000, sellers[0] ) ] \
+                          + [ trading.trade_t( "grain", 10., "USD", t, 1, buyers[t % 40] ) for t in range( 200 ) ] \
+                          + [ trading.trade_t( "grain", 9.5, "USD", t, 1, buyers[40 + t % 5] ) for t in range( 200 ) ]
+    for rescan in ( None, True ):
+        ref		= rewalk( "grain", rescan=rescan )
+        res		= resume( "grain", rescan=rescan )
+        ref.enter_many( orders, update=True )
+        res.enter_many( orders, update=True )
+        ref.calls = res.calls	= 0
+        trades		= list( res.execute( now=1000 ))
+        assert len( trades ) == 200 and trades == list( ref.execute( now=1000 ))
+        if rescan is True:
+            assert res.calls * 10 < ref.calls	# ~800 vs. ~40,000
+
+
+@markets()
+def test_market_snapshot( cls ):
+    """Snapshots are unaltered by subsequent trading, and their diffs replay the market's changes."""
+    m			= cls( "grain" )
+    m.enter_many( random_orders( 200 ))
+    before		= m.snapshot()
+    assert m.snapshot() is before			# Unchanged; the same snapshot
+    assert before.buying is m.buying			# Shared, until altered
+    books		= list( before.orders() )
+    opened		= before.diff()
+    assert before.price() == m.price()
+
+    trades		= list( m.execute( now=1000 ))
+    assert trades and before.buying is not m.buying
+    m.enter( trading.trade_t( "grain", None, "USD", 1001., 10, "agent A" ))
+    m.cancel( next( iter( m.order_ids )))
+    assert list( before.orders() ) == books
+    assert before.diff() == opened
+
+    after		= m.snapshot()
+    assert after is not before
+    assert after.price() == m.price() and after.last == trades[-1][0]
+    replayed		= dict( opened )
+    replayed.update( after.diff( before ))
+    assert dict( ( i, t ) for i,t in replayed.items() if t is not None ) == after.diff()
+    assert after.diff() == dict( m.order_items() )
+
+
+def test_exchange_snapshot():
+    """An exchange snapshot views, and diffs, every market's books."""
+    GSE			= trading.exchange( "GSE" )
+    GSE.enter( trading.trade_t( "corn", 5., "USD", 1., 10, "agent A" ))
+    before		= GSE.snapshot()
+    d			= GSE.enter( trading.trade_t( "grain", 10., "USD", 1., 10, "agent A" ))
+    after		= GSE.snapshot()
+    assert len( list( before.orders( "agent A" ))) == 1 and len( list( after.orders( "agent A" ))) == 2
+    assert list( after.diff( before )) == [ d ] and dict( after.order_items( security="grain" )) == { d: after.price( "grain" ).bid }
+
+
+def test_market_snapshot_release():
+    """A market's journal keeps only the changes since its oldest live snapshot, and is dropped w/o any."""
+    import gc
+    m			= trading.market( "grain" )
+    m.enter_many( random_orders( 200 ))
+    older		= m.snapshot()
+    list( m.execute( now=1000 ))
+    newer		= m.snapshot()
+    m.cancel( next( iter( m.order_ids )))
+    latest		= m.snapshot()
+    assert len( m.journal.changes ) == len( m.journal ) == latest.position > newer.position > 0
+    changes		= latest.diff( newer )
+    del older
+    gc.collect()
+    assert m.journal.start == newer.position and len( m.journal.changes ) == latest.position - newer.position
+    assert latest.diff( newer ) == changes
+    del newer
+    gc.collect()
+    assert not m.journal.changes and m.journal.start == latest.position
+    del latest
+    gc.collect()
+    assert m.journal is None and not m.snapshots
+    m.cancel( next( iter( m.order_ids )))		# Not logged
+    before		= m.snapshot()
+    list( m.execute( now=1001 ))
+    m.enter( trading.trade_t( "grain", None, "USD", 1002., 10, "agent A" ))
+    after		= m.snapshot()
+    replayed		= before.diff()
+    replayed.update( after.diff( before ))
+    assert dict( ( i, t ) for i,t in replayed.items() if t is not None ) == after.diff()
+
+
+def test_market_quote():
+    """Quotes match filling the limit price levels of the opposing book, as they are altered."""
+    def walk( m, amount ):
+        book		= m.selling if amount > 0 else reversed( m.buying )
+        left,value,worst = abs( amount ),0,None
+        for order in book:
+            if left <= 0:
+                break
+            if order.price is None:
+                continue
+            take	= min( left, abs( order.amount ))
+            left,value,worst = left - take,value + take * order.price,order.price
+        filled		= abs( amount ) - left
+        return ( value / filled if filled else None ),worst,filled
+
+    m			= trading.market_sorted( "grain" )
+    for order in random_orders( 300 ):
+        try:
+            m.enter( order )
+        except RuntimeError:
+            pass
+    for now in ( 100, 101 ):
+        for amount in ( 1, 50, 500, 5000, 1e9 ):
+            for signed in ( amount, -amount ):
+                vwap,worst,filled = walk( m, signed )
+                quote	= m.quote( signed )
+                assert near( quote.amount, filled ) and quote.worst == worst
+                assert vwap is None and quote.vwap is None or near( quote.vwap, vwap )
+        assert m.quote( 10, side="sell" ) == m.quote( -10 )
+        list( m.execute( now=now ))
+        # Partially fill the best bid and ask, without removing their price levels
+        bid,ask		= m.price()[:2]
+        m.enter( trading.trade_t( "grain", bid.price, "USD", now, -bid.amount / 2, "agent X" ))
+        m.enter( trading.trade_t( "grain", ask.price, "USD", now, -ask.amount / 2, "agent Y" ))
+        list( m.execute( now=now ))
+
+    GSE			= trading.exchange( "GSE" )
+    assert GSE.quote( "grain", 10 ) == ( None, None, 0 )
+    GSE.enter( trading.trade_t( "grain", 10., "USD", 1., -10, "agent A" ))
+    GSE.enter( trading.trade_t( "grain", 11., "USD", 2., -10, "agent B" ))
+    assert GSE.quote( "grain", 15 ) == ( 31. / 3, 11., 15 )
+
+
+@needs_numpy
+def test_market_policy():
+    """Agents with a declarative policy trade exactly as agents implementing the same rules by method,
+    without sells_to/buys_from being called.
+
+    """
+    rules		= trading.policy( {
+        "reserve":	dict( sells_to=( "member", )),
+        "public":	dict( buys_from=( "public", "member" )),
+    } )
+    assert rules.compatible( "member", "reserve" ) and not rules.compatible( "public", "reserve" )
+    assert not rules.compatible( "public", None ) and rules.compatible( None, "member" )
+    assert not rules.compatible( None, "reserve" )
+    assert list( rules.compatible_many( [ "member", "public", "public", None ],
+                                        [ "reserve", "reserve", "member", "public" ] )) == [ True, False, True, True ]
+
+    class declared( trading.agent ):
+        policy		= rules
+        def sells_to( self, another ):
+            raise AssertionError( "sells_to called" )
+
+    class coded( trading.agent ):
+        def sells_to_group( self, group ):
+            return self.group != "reserve" or group == "member"
+        def buys_from_group( self, group ):
+            return self.group != "public" or group in ( "public", "member" )
+
+    rnd			= random.Random( 0 )
+    groups		= [ "reserve" ] * 2 + [ "public" ] * 6 + [ "member" ] * 2
+    names		= [ "{} {}".format( g, i ) for i,g in enumerate( groups ) ]
+    markets		= []
+    for cls in ( declared, coded ):
+        agents		= {}
+        for g,n in zip( groups, names ):
+            agents[n]	= cls( n )
+            agents[n].group = g
+        m		= trading.market( "grain" )
+        rnd.seed( 0 )
+        for t in range( 200 ):
+            m.enter( trading.trade_t( "grain", round( rnd.uniform( 9.0, 10.1 ), 2 ), "USD", t,
+                                      rnd.randint( 1, 100 ) * rnd.choice( ( -1, 1 )), agents[rnd.choice( names )] ),
+                     update=True )
+        markets.append( [ ( str( b.agent ), str( s.agent ), b.price, b.amount ) for b,s in m.execute( now=1000 ) ] )
+    assert markets[0] and markets[0] == markets[1]
+
+
+@markets( trading.market, trading.market_sorted, columnar, auction )
+def test_market_fixed( cls ):
+    """A fixed-point market executes the same trades as a floating-point one, in the same units; and equal
+    prices (in ticks) are equal, even where their floating-point values are not.
+
+    """
+    orders		= [ o._replace( price=None if o.price is None else round( o.price, 2 ))
+                            for o in random_orders( 300 ) ]
+    ref			= entered( cls, orders )
+    fix			= entered( cls, orders, tick=.01, lot=1 )
+    assert all( type( o.price ) is int for o in fix.buying if o.price is not None )
+    for a,b in zip( ref.orders(), fix.orders() ):
+        assert a.agent == b.agent and a.amount == b.amount
+        assert ( a.price is None ) == ( b.price is None ) and ( a.price is None or near( a.price, b.price ))
+    assert near( ref.price().bid.price, fix.price().bid.price )
+    ref_q,fix_q		= ref.quote( 1000 ),fix.quote( 1000 )
+    assert near( ref_q.vwap, fix_q.vwap ) and ref_q.amount == fix_q.amount
+    for ( rb,rs ),( fb,fs ) in zip( ref.execute( now=1000 ), fix.execute( now=1000 )):
+        assert rb.agent == fb.agent and rs.agent == fs.agent and rb.amount == fb.amount
+        assert near( rb.price, fb.price )
+
+
+def test_market_fixed_units():
+    """Prices equal in ticks trade at the identical price; an updated order is converted to ticks/lots once."""
+    m			= trading.market( "grain", tick=.01 )
+    m.sell( "agent A", 10, price=.1 + .2, now=1 )
+    m.buy(  "agent B", 10, price=.3, now=2 )
+    ( buy,sell ),	= m.execute( now=3 )
+    assert buy.price == sell.price == 30 * .01 and buy.amount == 10
+
+    # Updating an agent's order re-prices and re-sizes it in ticks and lots, without converting it twice
+    m			= trading.market( "grain", tick=.01, lot=.5 )
+    a			= m.buy( "agent A", 10, price=9.99, now=1, update=True )
+    assert m.buy( "agent A", 10, price=9.50, now=2, update=True ) == a
+    assert m.buying[-1].price == 950 and m.buying[-1].amount == 20
+    bid			= m.price().bid
+    assert near( bid.price, 9.50 ) and bid.amount == 10
+    assert m.buy( "agent A", 15, price=9.50, now=3, update=True ) == a
+    assert m.buying[-1].amount == 30 and m.price().bid.amount == 15 and len( m.buying ) == 1
+
+
+def test_market_subscribe():
+    """Subscribers receive each trade as it is executed, within their bounded buffers."""
+    import threading
+
+    m			= trading.market( "grain" )
+    for order in random_orders( 200 ):
+        m.enter( order )
+    heard		= []
+    m.subscribe( callback=heard.append )
+    every		= m.subscribe( maxlen=1000 )
+    recent		= m.subscribe( maxlen=5 )
+    first		= next( m.execute( now=1000 ))
+    assert heard == [ first ] and list( every ) == [ first ] and not len( every )
+    trades		= [ first ] + list( m.execute( now=1000 ))
+    assert len( trades ) > 10
+    assert heard == trades
+    assert list( every ) == trades[1:]
+    assert list( recent ) == trades[-5:] and recent.dropped == len( trades ) - 5
+    m.unsubscribe( recent )
+    assert recent not in m.subscribers
+
+    # A blocking subscriber applies backpressure; the market waits for a consumer thread
+    GSE			= trading.exchange( "GSE" )
+    slow		= GSE.subscribe( maxlen=1, block=True )
+    taken		= []
+    def consume():
+        while True:
+            trade	= slow.get( timeout=5 )
+            if trade is None:
+                return
+            taken.append( trade )
+    for order in random_orders( 200 ):
+        GSE.enter( order, update=False )
+    consumer		= threading.Thread( target=consume )
+    consumer.start()
+    trades		= list( GSE.execute( now=1000 ))
+    slow.close()
+    consumer.join()
+    assert trades and taken == trades and not slow.dropped
+
+
+def test_market_aggregator():
+    """The aggregator's bars and indicators match those computed from the whole trade history."""
+    m			= trading.market( "grain" )
+    agg			= trading.aggregator( resolutions=( trading.minute, trading.hour ), length=3, period=trading.minute )
+    agg.attach( m )
+    rnd			= random.Random( 0 )
+    trades		= []
+    for t in range( 0, 4 * trading.hour, 7 ):
+        m.buy(  "buyer",  rnd.randint( 1, 10 ), price=round( rnd.uniform( 9, 11 ), 2 ), now=t )
+        m.sell( "seller", rnd.randint( 1, 10 ), price=round( rnd.uniform( 9, 11 ), 2 ), now=t )
+        trades.extend( buy for buy,_ in m.execute( now=t ))
+    assert trades and agg.last == trades[-1]
+
+    for resolution,bars in agg.bars.items():
+        assert len( bars ) == 3
+        for bar in bars:
+            during	= [ t for t in trades if bar.time <= t.time < bar.time + resolution ]
+            assert bar.open == during[0].price and bar.close == during[-1].price
+            assert bar.high == max( t.price for t in during ) and bar.low == min( t.price for t in during )
+            assert bar.volume == sum( t.amount for t in during )
+        recent		= [ t for t in trades if t.time >= bars[0].time ]
+        assert near( agg.vwap( resolution ), sum( t.amount * t.price for t in recent ) / sum( t.amount for t in recent ))
+    assert agg.vwap() == agg.vwap( trading.hour )
+
+    weights		= [ t.amount * math.exp( -( trades[-1].time - t.time ) / trading.minute ) for t in trades ]
+    assert near( agg.ema, sum( w * t.price for w,t in zip( weights, trades )) / sum( weights ))
+
+
+def test_histogram():
+    """A histogram counts values in buckets bounded by exact powers of its base."""
+    h			= trading.histogram()
+    for value in range( 1000 ):
+        h.add( value )
+    assert len( h ) == 1000 and h.lowest == 0 and h.highest == 999 and near( h.mean(), 499.5 )
+    assert len( h.buckets ) <= 11
+    assert 500 <= h.quantile( .5 ) <= 1000 and h.quantile( 1 ) == 999
+    assert sum( count for _,_,count in h ) == 1000
+
+    # Exact powers of the base begin their buckets (math.log( 1000, 10 ) is 2.9999999999999996)
+    h			= trading.histogram( base=10 )
+    for value in ( .5, 1, 9, 10, 999, 1000, 10**15 ):
+        h.add( value )
+    assert [ ( lower, upper ) for lower,upper,_ in h ] == [
+        ( -math.inf, 1 ), ( 1, 10 ), ( 10, 100 ), ( 100, 1000 ), ( 1000, 10000 ), ( 10**15, 10**16 ) ]
+    assert [ count for _,_,count in h ] == [ 1, 2, 1, 1, 1, 1 ]
+
+
+@markets( trading.market, columnar, auction )
+def test_market_statistics( cls ):
+    """Order ages at fill, time to first fill and book depth are counted in bounded histograms."""
+    m			= cls( "grain" )
+    m.sell( "seller", 10, price=10., now=0 )
+    m.buy(  "buyer A", 4, price=10., now=5 )
+    list( m.execute( now=10 ))
+    m.buy(  "buyer B", 6, price=10., now=20 )
+    list( m.execute( now=30 ))
+    # The sell was filled at ages 10 and 30 (first at 10); the buys at ages 5 and 10
+    assert m.ages.count == 4 and m.ages.total == 10 + 5 + 30 + 10
+    assert m.waits.count == 3 and m.waits.total == 10 + 5 + 10
+    assert m.depths.count == 2 and m.depths.total == 2 + 2
+
+
+@markets()
+def test_market_prices( cls ):
+    """A market's cached price is recomputed only when its books change (incl. by fills)."""
+    m			= cls( "grain" )
+    for order in random_orders( 200 ):
+        try:
+            m.enter( order )
+        except RuntimeError:
+            pass
+        assert m.price() == m._price()
+    price		= m.price()
+    version		= m.version
+    assert m.price() is price and m.version == version
+    assert m.prices( [ "grain", "grain" ] ) == [ price, price ]
+    for now in ( 100, 101 ):
+        for trade in m.execute( now=now ):
+            assert m.price() == m._price()
+        assert m.version > version
+        version		= m.version
+        m.cancel( m.buying[-1].id )
+        assert m.version > version and m.price() == m._price()
+
+
+def test_exchange_prices():
+    """An exchange's prices are those of each security's market, or none."""
+    GSE			= trading.exchange( "GSE" )
+    GSE.enter( trading.trade_t( "grain", 10., "USD", 1., -10, "agent A" ))
+    GSE.enter( trading.trade_t( "corn", 5., "USD", 1., 10, "agent A" ))
+    grain,corn,none	= GSE.prices( [ "grain", "corn", "wheat" ] )
+    assert grain.bid is None and grain.ask.price == 10. and grain.last is None
+    assert corn.bid.price == 5. and corn.ask is None
+    assert none == ( None, None, None )
+    GSE.enter( trading.trade_t( "grain", 10., "USD", 2., 5, "agent B" ))
+    assert GSE.price( "grain" ) is not grain
+    list( GSE.execute( now=3. ))
+    assert GSE.price( "grain" ).last.price == 10. and GSE.price( "grain" ).ask.amount == -5
+
+
+@needs_numpy
+def test_exchange_fx():
+    """A multi-currency exchange converts via its FX markets' prices, crossing where no direct market exists."""
+    FX			= trading.exchange_fx( "FX/USD", currencies=( "EUR", "CAD" ))
+    assert FX.currencies == [ "USD", "EUR", "CAD" ]
+    assert FX.rate( "USD" ) == 1. and math.isnan( FX.rate( "EUR" ))
+    FX.enter( trading.trade_t( "HOT", .002, "EUR", 1., -1000, "agent A" ))
+    FX.enter( trading.trade_t( "HOT", .001, "USD", 1., -1000, "agent A" ))
+    assert FX.price( "HOT/EUR" ).ask.price == .002 and FX.price( "HOT" ).ask.price == .001
+    assert FX.valuations( [ "HOT", "corn" ] ) == [ .001, 0 ]	# HOT/EUR not yet convertible
+
+    # EUR/USD only has a bid and ask; the mid is used 'til it trades
+    FX.enter( trading.trade_t( "EUR", 1.10, "USD", 2., 100, "agent B" ))
+    FX.enter( trading.trade_t( "EUR", 1.20, "USD", 2., -100, "agent C" ))
+    FX.enter( trading.trade_t( "USD", 1.25, "CAD", 2., -100, "agent C" ))
+    rates		= FX.rates()
+    assert FX.rates() is rates		# Cached, while the FX markets are unchanged
+    assert near( FX.rate( "EUR" ), 1.15 ) and near( FX.rate( "USD", "EUR" ), 1 / 1.15 )
+    assert near( FX.rate( "EUR", "CAD" ), 1.15 * 1.25 )	# Crossed via USD
+    assert near( FX.convert( 10, "CAD", "EUR" ), 10 / 1.25 / 1.15 )
+    assert near( FX.valuations( [ "HOT" ] )[0], .002 * 1.15 )
+    assert near( FX.valuations( [ "HOT" ], currency="CAD" )[0], .002 * 1.15 * 1.25 )
+
+    # Entering a non-FX order leaves the rates alone; an FX trade updates them
+    FX.enter( trading.trade_t( "HOT", .0011, "USD", 3., -10, "agent D" ))
+    assert FX.rates() is rates
+    FX.enter( trading.trade_t( "EUR", 1.20, "USD", 3., 10, "agent D" ))
+    list( FX.execute( now=4. ))
+    assert FX.rates() is not rates and near( FX.rate( "EUR", "CAD" ), 1.20 * 1.25 )
+    assert FX.price( "EUR" ).last.price == 1.20
+
+    # A currency the exchange doesn't support has no conversion, and values nothing
+    assert math.isnan( FX.rate( "JPY" )) and math.isnan( FX.rate( "USD", "JPY" )) and FX.rate( "JPY", "JPY" ) == 1.
+    assert math.isnan( FX.convert( 10, "EUR", "JPY" ))
+    assert FX.valuations( [ "HOT", "corn" ], currency="JPY" ) == [ 0, 0 ]
+    with pytest.raises( AssertionError ):
+        FX.enter( trading.trade_t( "HOT", .1, "JPY", 5., -10, "agent A" ))
+
+
+def exchange_cycle( GSE ):
+    """Enter random orders on the exchange GSE, and query, close, cancel and execute them; returns the trades,
+    queries and agents' records (w/ each agent by identity), comparable between exchanges, and the agents.
+
+    """
+    heard		= []
+    GSE.subscribe( callback=heard.append )
+    agents		= dict( ( n, trading.agent( n )) for n in ( "A", "B", "C", "D", "E" ))
+    rnd			= random.Random( 0 )
+    for t in range( 300 ):
+        security	= rnd.choice( [ "s{:02d}".format( i ) for i in range( 8 ) ] )
+        GSE.enter( trading.trade_t( security, round( rnd.uniform( 9, 11 ), 2 ), "USD", t,
+                                    rnd.randint( 1, 100 ) * rnd.choice( ( -1, 1 )),
+                                    agents[rnd.choice( sorted( agents ))] ))
+    ids			= GSE.enter_many( [ trading.trade_t( "s00", 5., "USD", 300, -10, agents["A"] ),
+                                            trading.trade_t( "s09", 20., "USD", 300, 10, agents["A"] ) ] )
+    assert len( ids ) == 2 and GSE.cancel( ids[1] ).security == "s09"
+    opened		= sorted( ( o.security, o.price, o.amount ) for o in GSE.orders( agents["B"] ))
+    prices		= GSE.prices( [ "s01", "s07", "nope" ] )
+    assert prices[0] == GSE.price( "s01" ) and prices[2] == ( None, None, None )
+    GSE.close( agents["C"], security="s02" )
+    trades		= GSE.execute_all( now=1000 )
+    assert heard == trades
+    assert all( o.agent in agents.values() for trade in trades for o in trade )
+    return ( [ tuple( t._replace( agent=t.agent.identity ) for t in trade )
+               for trade in sorted( trades, key=lambda t: t[0].security ) ],
+             opened, [ tuple( p and ( p.price, p.agent.identity ) for p in ps[:2] ) for ps in prices ],
+             GSE.quote( "s03", 50 ),
+             dict( ( n, ( a.assets, a.balances )) for n,a in agents.items() )),agents
+
+
+def test_exchange_sharded():
+    """Markets sharded across processes yield the same trades, prices and agent records as one exchange."""
+    expected,_		= exchange_cycle( trading.exchange( "GSE" ))
+    GSE			= trading.exchange_sharded( "GSE", shards=3 )
+    try:
+        results,agents	= exchange_cycle( GSE )
+
+        # Queries reflect every order entered, closed, cancelled or amended since
+        bid		= GSE.price( "s03" ).bid
+        id		= GSE.enter( trading.trade_t( "s03", 99., "USD", 1001, 5, agents["E"] ))	# Amends E's order
+        assert GSE.price( "s03" ).bid.price == 99.
+        ( retained,_ ),	= GSE.order_items( agents["E"], security="s03" )
+        assert retained != id and GSE.amend( id, 5 ) == retained
+        assert [ o.price for o in GSE.orders( agents["E"], security="s03" ) ] == [ 99. ]
+        GSE.close( agents["E"], security="s03" )
+        assert GSE.price( "s03" ).bid == bid and not list( GSE.orders( agents["E"], security="s03" ))
+        id		= GSE.enter( trading.trade_t( "s03", 98., "USD", 1002, 5, agents["E"] ))
+        GSE.amend( id, 3, price=99. )
+        assert [ ( o.price, o.amount ) for o in GSE.orders( agents["E"], security="s03" ) ] == [ ( 99., 3 ) ]
+        assert [ i for i,_ in GSE.order_items( agents["E"], security="s03" ) ] == [ id ]
+        assert GSE.amend( id, 4, now=1003 ) == id
+        assert list( GSE.orders( agents["E"], security="s03" )) == [
+            trading.trade_t( "s03", 99., "USD", 1003, 4, agents["E"] ) ]
+        GSE.cancel( id )
+        assert GSE.price( "s03" ).bid == bid
+
+        # An agent's group and policy are sent to the shards once; its proxy then pickles as its token
+        proxy		= GSE.proxies[agents["E"]]
+        proxy.group	= "reserve"
+        assert vars( pickle.loads( pickle.dumps( proxy ))) == dict( token=proxy.token, group=None, policy=None )
+
+        # Agents deciding their own compatibility are refused
+        class picky( trading.agent ):
+            def buys_from( self, another ):
+                return False
+        with pytest.raises( AssertionError ):
+            GSE.enter( trading.trade_t( "s03", 99., "USD", 1004, 5, picky( "F" )))
+    finally:
+        GSE.shutdown()
+    assert expected[0] and expected[:4] == results[:4]
+    for n,( assets,balances ) in expected[4].items():
+        assert assets == results[4][n][0]
+        assert all( near( v, results[4][n][1][c] ) for c,v in balances.items() )
+
+
+def test_exchange_pooled():
+    """An exchange's markets executed concurrently in a pool yield the same trades, prices and agent records as
+    executed in turn; the trades are settled in market name order, and snapshots remain valid.
+
+    """
+    expected,_			= exchange_cycle( trading.exchange( "GSE" ))
+    pool			= multiprocessing.Pool( 3 )
+    try:
+        GSE			= trading.exchange( "GSE" )
+        serial			= GSE.execute_all
+        GSE.execute_all		= lambda **kwds: serial( pool=pool, **kwds )
+        results,agents		= exchange_cycle( GSE )
+        assert expected[0] and expected[:4] == results[:4]
+        for n,( assets,balances ) in expected[4].items():
+            assert assets == results[4][n][0]
+            assert all( near( v, results[4][n][1][c] ) for c,v in balances.items() )
+        assert all( o.agent in agents.values() for m in GSE.markets.values() for o in m.order_ids.values() )
+
+        # Trades are settled in market name order; a snapshot's diff includes the changes executed
+        before			= GSE.markets["s03"].snapshot()
+        A,B			= agents["A"],agents["B"]
+        GSE.enter( trading.trade_t( "s03", 1., "USD", 1001, -5, A ))
+        GSE.enter( trading.trade_t( "s01", 1000., "USD", 1001, 5, B ))
+        GSE.enter( trading.trade_t( "s01", 1., "USD", 1001, -5, A ))
+        trades			= serial( now=1002, pool=pool )
+        assert [ t[0].security for t in trades ] == sorted( t[0].security for t in trades )
+        assert len( set( t[0].security for t in trades )) == 2
+        after			= GSE.markets["s03"].snapshot()
+        assert after.diff( before ) and dict( before.order_items() ) != dict( after.order_items() )
+        assert dict( after.order_items() ) == dict( GSE.markets["s03"].order_items() )
+
+        # Agents deciding their own compatibility are refused
+        class picky( trading.agent ):
+            def buys_from( self, another ):
+                return False
+        GSE.enter( trading.trade_t( "s03", 99., "USD", 1003, 5, picky( "F" )))
+        with pytest.raises( AssertionError ):
+            serial( now=1004, pool=pool )
+    finally:
+        pool.terminate()
+
+
+def test_exchange_sharded_errors():
+    """A sharded exchange's enter returns the order's id at once; any error entering it is raised by the next
+    call needing its shard's reply.  An error in a queued call is raised by execute_all only after every
+    trade executed has been published and recorded.
+
+    """
+    GSE			= trading.exchange_sharded( "GSE", shards=2 )
+    try:
+        heard		= []
+        GSE.subscribe( callback=heard.append )
+        A,B		= trading.agent( "A" ),trading.agent( "B" )
+        bad		= GSE.enter( trading.trade_t( "s00", "ninety", "USD", 1., 5, A ))
+        assert ( bad - 1 ) % GSE.shards == GSE.placement["s00"]
+        with pytest.raises( TypeError ):
+            GSE.price( "s00" )
+        a		= GSE.enter( trading.trade_t( "s00", 10., "USD", 1., 5, A ))
+        b		= GSE.enter( trading.trade_t( "s01", 20., "USD", 1., 5, B ))
+        assert len( set(( bad, a, b ))) == 3 and ( b - 1 ) % GSE.shards == GSE.placement["s01"]
+
+        # An order updating the agent's existing one is reported by the retained order's id, but its own
+        # id also refers to it, 'til it is no longer open
+        u		= GSE.enter( trading.trade_t( "s00", 10., "USD", 1., 5, A ))	# unchanged
+        assert u != a and [ i for i,_ in GSE.order_items( A ) ] == [ a ]
+        assert GSE.amend( u, 4 ) == a
+        assert [ ( i, o.amount ) for i,o in GSE.order_items( A ) ] == [ ( a, 4 ) ]
+        assert GSE.cancel( u ).amount == 4 and not list( GSE.orders( A ))
+        a		= GSE.enter( trading.trade_t( "s00", 10., "USD", 1., 5, A ))
+
+        # A bad order queued to s00's shard fails only during the execute
+        GSE.enter( trading.trade_t( "s00", 10., "USD", 2., -5, B ))
+        GSE.enter( trading.trade_t( "s00", "ninety", "USD", 3., 5, A ), update=False )
+        with pytest.raises( TypeError ):
+            GSE.execute_all( now=4. )
+        assert [ ( buy.agent, sell.agent, buy.amount ) for buy,sell in heard ] == [ ( A, B, 5 ) ]
+        assert A.assets["s00"] == 5 and B.assets["s00"] == -5
+        assert not list( GSE.orders( A )) and [ o.price for o in GSE.orders( B ) ] == [ 20. ]
+    finally:
+        GSE.shutdown()
+
+
+def _read_mirror( name, conn ):
+    """Read a book_mirror from another process."""
+    mirror		= trading.book_mirror.attach( name )
+    conn.send( [ a.tolist() for a in mirror.read()[1:] ] )
+    mirror.close()
+
+
+def test_market_mirror():
+    """A market's top-of-book and depth are mirrored in shared memory, readable from other processes."""
+    import multiprocessing
+    if trading.mirror.numpy is None or trading.mirror.shared_memory is None:
+        pytest.skip( "book_mirror requires NumPy and multiprocessing.shared_memory (Python 3.8+)" )
+    m			= trading.market( "grain", tick=.01, lot=.5 )
+    for order in random_orders( 200 ):
+        try:
+            m.enter( order )
+        except RuntimeError:
+            pass
+    mirror		= m.mirror( levels=5 )
+    try:
+        sequence,top,bids,asks = mirror.read()
+        bid,ask,last	= m.price()
+        assert near( top[0], bid.price ) and near( top[1], bid.amount ) and math.isnan( top[4] )
+        assert near( top[2], ask.price ) and near( top[3], -ask.amount )
+        assert len( bids ) == 5 and near( bids[0][0], bid.price ) and list( bids[:,0] ) == sorted( bids[:,0], reverse=True )
+        assert len( asks ) == 5 and near( asks[0][0], ask.price ) and list( asks[:,0] ) == sorted( asks[:,0] )
+        assert near( bids[0][1], sum( o.amount for o in m.orders() if o.amount > 0 and o.price == bid.price ))
+
+        # Unchanged books are not re-published; an execute re-publishes
+        assert not mirror.publish( m ) and mirror.read()[0] == sequence
+        m.execute_all( now=100, record=False )
+        assert mirror.read()[0] > sequence
+        assert near( mirror.read()[1][4], m.price().last.price )
+
+        # A zero-copy view is valid 'til the next publish
+        begun		= mirror.begin()
+        view		= mirror.top
+        assert mirror.valid( begun )
+        m.cancel( next( iter( m.order_ids )))
+        mirror.publish( m )
+        assert not mirror.valid( begun ) and view is mirror.top
+
+        conn,child	= multiprocessing.Pipe()
+        reader		= multiprocessing.Process( target=_read_mirror, args=( mirror.name, child ))
+        reader.start()
+        top,bids,asks	= conn.recv()
+        reader.join()
+        assert top[:4] == mirror.top[:4].tolist() and bids == mirror.read()[2].tolist()
+    finally:
+        mirror.close()
+        mirror.unlink()